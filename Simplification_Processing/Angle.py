@@ -1,7 +1,7 @@
 import numpy as np
 from shapely.geometry import Point, LineString, Polygon
 from numpy.linalg import norm
-from math import pi
+from math import pi, sqrt, nan
 
 
 
@@ -22,6 +22,17 @@ def AngleCal(l1, l2):
     angle = (v1[0] * v2[0] + v1[1] * v2[1]) / (norm(v1, ord=2, axis=0) * norm(v2, ord=2, axis=0))
     return angle
 
+def AngleCal_ends(s1, e1, s2, e2):
+    '''
+    AngleCal of two lines given by their start and end coordinates, nan if one of them is closed
+    '''
+    v1 = (s1[0] - e1[0], s1[1] - e1[1])
+    v2 = (s2[0] - e2[0], s2[1] - e2[1])
+    length = sqrt(v1[0] * v1[0] + v1[1] * v1[1]) * sqrt(v2[0] * v2[0] + v2[1] * v2[1])
+    if length == 0:
+        return nan
+    return (v1[0] * v2[0] + v1[1] * v2[1]) / length
+
 def AngleCal_turning(l1, l2, intersctpt):
     '''
     geom of intersection with geoms of relevant links
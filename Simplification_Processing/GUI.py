@@ -4,9 +4,6 @@
 import tkinter as tk
 from tkinter import filedialog, messagebox, ttk
 import threading
-from shapely.strtree import STRtree
-from concurrent.futures import ProcessPoolExecutor, as_completed
-from shapely import wkb as _wkb
 import warnings
 import sys
 import os
@@ -24,6 +21,7 @@ from matplotlib.lines import Line2D
 
 # --- IMPORTS DO REPOSITÓRIO (seu código) ---
 from Graph_structure import Crossing_Checking, GraphBuilder
+from noding import assign_split_nodes, build_topology
 
 warnings.simplefilter("ignore")
 
@@ -35,24 +33,6 @@ def resource_path(relative_path):
         base_path = os.path.dirname(__file__)
     return os.path.join(base_path, relative_path)
 
-# --- helper para multiprocessing: precisa ser top-level no Windows ---
-def _check_pair_wkb(i, j, wkb1, wkb2):
-    g1 = _wkb.loads(wkb1)
-    g2 = _wkb.loads(wkb2)
-    if not g1.intersects(g2):
-        return None
-    inter = g1.intersection(g2)
-    if inter.is_empty:
-        return None
-    pts = []
-    if inter.geom_type == 'Point':
-        pts = [(inter.x, inter.y)]
-    elif inter.geom_type == 'MultiPoint':
-        pts = [(p.x, p.y) for p in inter.geoms]
-    # ignoramos sobreposições colineares (LineString/MultiLineString)
-    return (i, j, pts) if pts else None
-
-
 # ---------- util: redirecionar stdout/stderr para o Text (TEE com filtro) ----------
 class TeeToText:
     def __init__(self, text_widget, orig_stream, filter_fn=None):
@@ -145,6 +125,12 @@ class URNApp(tk.Tk):
         # Para arquivo local
         self.local_shp_path = tk.StringVar()
         self.output_name = tk.StringVar()
+        # noding em passo único (noding.build_topology) ou Crossing_Checking + graph_connections
+        self.single_pass = tk.BooleanVar(value=False)
+        # backend das interseções: "strtree" (pares de linhas) ou "sweep" (varredura de segmentos)
+        self.noding_method = tk.StringVar(value="strtree")
+        # grade de precisão (m) do GraphBuilder, ex. 0.01 = 1 cm; vazio compara as coordenadas em float
+        self.grid_size = tk.StringVar(value="")
 
         # Busca OSM
         self.place_query = tk.StringVar()
@@ -184,6 +170,18 @@ class URNApp(tk.Tk):
                   command=self._thread(self.download_and_show_osm),
                   bg="#2b7", fg="white").grid(row=0, column=3, padx=10)
 
+        noding = tk.Frame(top)
+        noding.grid(row=1, column=3, sticky="w", padx=10)
+        tk.Checkbutton(noding, text="Noding em passo único",
+                       variable=self.single_pass).pack(side=tk.TOP, anchor="w")
+        ttk.Combobox(noding, textvariable=self.noding_method, values=["strtree", "sweep"],
+                     state="readonly", width=10).pack(side=tk.TOP, anchor="w")
+        grid = tk.Frame(noding)
+        grid.pack(side=tk.TOP, anchor="w")
+        tk.Label(grid, text="Grade (m):").pack(side=tk.LEFT)
+        ttk.Combobox(grid, textvariable=self.grid_size, values=["", "0.01", "0.001"],
+                     width=6).pack(side=tk.LEFT)
+
         ttk.Separator(top, orient="vertical").grid(row=0, column=4, rowspan=2, sticky="ns", padx=10)
 
         # Arquivo local
@@ -606,93 +604,61 @@ class URNApp(tk.Tk):
         data = gdf.set_index('full_id').to_dict('index')
         geo_keys = list(data.keys())
 
-        # ===== STRtree para reduzir pares =====
+        # ===== noding compartilhado com main.py (STRtree + ufuncs do shapely 2) =====
         geoms = [data[k]['geometry'] for k in geo_keys]
-        valid_idx = [i for i, g in enumerate(geoms) if g is not None and not g.is_empty]
-        geoms = [geoms[i] for i in valid_idx]
-        keys_valid = [geo_keys[i] for i in valid_idx]
-
-        if not geoms:
+        if not any(g is not None and not g.is_empty for g in geoms):
             messagebox.showerror("Erro", "Nenhuma geometria válida para converter.")
             return
 
-        # índice espacial
-        tree = STRtree(geoms)
         # log de versão em runtime
         self._log(f"Shapely {shapely.__version__} | GEOS {getattr(shapely, 'geos_version_string', 'n/a')}\n")
+        self._log("Verificando interseções…\n")
+        self.set_progress(20, "Interseções…")
 
-        # gerar pares candidatos com predicate="intersects"
-        pairs = []
-        try:
-            # Shapely 2.x: query aceita sequência de geometrias e retorna (src_idx, dst_idx)
-            src_idx, dst_idx = tree.query(geoms, predicate="intersects")
-            pairs = [(int(i), int(j)) for i, j in zip(src_idx, dst_idx) if i < j]
-        except TypeError:
-            # Fallback para builds antigas: query(g) retorna geometrias
-            wkb_to_idx = {g.wkb: i for i, g in enumerate(geoms)}
-            seen = set()
-            for i, g in enumerate(geoms):
-                for gj in tree.query(g):  # bbox candidates
-                    j = wkb_to_idx.get(gj.wkb)
-                    if j is None or j == i:
-                        continue
-                    a, b = (i, j) if i < j else (j, i)
-                    if (a, b) not in seen:
-                        seen.add((a, b))
-            pairs = list(seen)
-
-        total_pairs = len(pairs)
-        self._log(f"Verificando interseções (candidatos: {total_pairs})…\n")
-
-        # ===== multiprocessamento por pares =====
-        geoms_wkb = [gg.wkb for gg in geoms]
-
-        # acumuladores por índice local (0..len(geoms)-1)
-        nodes_acc = [[] for _ in geoms]
-
-        checked = 0
-        max_workers = os.cpu_count() or 2
-        chunk_size = 5000  # ajuste se quiser
+        # workers recebem todas as geometrias uma vez (initializer) e processam fatias contíguas de pares
+        def _progress(done, total):
+            pct = 20 + int(72 * done / total) if total else 92
+            self.set_progress(pct, f"Interseções… {pct}%")
 
+        single_pass = self.single_pass.get()
+        method = self.noding_method.get()
         try:
-            with ProcessPoolExecutor(max_workers=max_workers) as ex:
-                for start in range(0, total_pairs, chunk_size):
-                    end = min(start + chunk_size, total_pairs)
-                    batch = pairs[start:end]
-                    futures = [
-                        ex.submit(_check_pair_wkb, i, j, geoms_wkb[i], geoms_wkb[j])
-                        for (i, j) in batch
-                    ]
-                    for fut in as_completed(futures):
-                        res = fut.result()
-                        checked += 1
-                        if res:
-                            i, j, pts = res
-                            if pts:
-                                # reconstrói Point apenas na thread principal
-                                for x, y in pts:
-                                    p = shapely.geometry.Point(x, y)
-                                    nodes_acc[i].append(p)
-                                    nodes_acc[j].append(p)
-                        if total_pairs:
-                            pct = min(92, int(100 * checked / total_pairs))
-                            self.set_progress(pct, f"Interseções… {pct}%")
+            grid_size = float(self.grid_size.get()) if self.grid_size.get().strip() else None
+            if grid_size is not None and grid_size <= 0:
+                raise ValueError
+        except ValueError:
+            messagebox.showerror("Erro", f"Grade inválida: {self.grid_size.get()}")
+            self.set_progress(0, "Erro.")
+            return
+        self._log(f"Backend de interseções: {method}\n")
+        topology = None
+        try:
+            if single_pass:
+                topology = build_topology(geoms, workers=os.cpu_count() or 2, progress=_progress, method=method,
+                                          points=True)
+            else:
+                assign_split_nodes(data, geo_keys, workers=os.cpu_count() or 2, progress=_progress,
+                                   method=method)
         except Exception as e:
             self._log(f"Erro nas interseções: {e}\n")
             messagebox.showerror("Erro", f"Falha ao checar interseções: {e}")
             self.set_progress(0, "Erro.")
             return
-
-        # grava de volta nos dicionários originais (usando as chaves reais)
-        for local_idx, key in enumerate(keys_valid):
-            data[key]['nodes'].extend(nodes_acc[local_idx])
+        self.set_progress(92, "Interseções… 100%")
 
         # ========== Crossing_Checking + GraphBuilder ==========
         try:
-            self._log("Calculando links de separação (Crossing_Checking)…\n")
-            self.set_progress(94, "Calculando links…")
-            separatLi, _ = Crossing_Checking(data, geo_keys)
-            linkstg = list(separatLi)
+            if single_pass:
+                linkstg, link, node, node_storage, pts_list = topology
+                # mesmos 'nodes' que assign_split_nodes preencheria
+                for k, pts in zip(geo_keys, pts_list):
+                    data[k]['nodes'].extend(shapely.points(pts).tolist())
+            else:
+                self._log("Calculando links de separação (Crossing_Checking)…\n")
+                self.set_progress(94, "Calculando links…")
+                separatLi, _ = Crossing_Checking(data, geo_keys, workers=os.cpu_count() or 2)
+                linkstg = list(separatLi)
+                link, node, node_storage = dict(), dict(), []
             self.converted_lines = linkstg
 
             # salvar estrutura URN do repositório no diretório/base escolhidos
@@ -704,22 +670,24 @@ class URNApp(tk.Tk):
                     os.makedirs(out_dir, exist_ok=True)
                     os.chdir(out_dir)
                     self._log(f"Salvando em: {out_dir} (base: {out_base})\n")
-                    urn_graph = GraphBuilder(linkstg, dict(), dict(), [], out_base)
-                    urn_graph.run()
+                    urn_graph = GraphBuilder(linkstg, link, node, node_storage, out_base,
+                                             workers=os.cpu_count() or 2, grid_size=grid_size)
+                    urn_graph.run(noded=single_pass)
                     urn_graph.save()
                 finally:
                     os.chdir(prev)
             else:
                 self._log(f"Salvando (base: {out_base})\n")
-                urn_graph = GraphBuilder(linkstg, dict(), dict(), [], out_base)
-                urn_graph.run()
+                urn_graph = GraphBuilder(linkstg, link, node, node_storage, out_base,
+                                         workers=os.cpu_count() or 2, grid_size=grid_size)
+                urn_graph.run(noded=single_pass)
                 urn_graph.save()
 
             # ====== exporta GeoJSON “URN” (linhas) ======
             try:
                 out_geojson = savename_path if savename_path.lower().endswith(".geojson") \
                             else savename_path + ".geojson"
-                geoms_out = self._flatten_lines_all(linkstg)
+                geoms_out = self._flatten_lines_all(urn_graph.link_storage)
                 ids = list(range(len(geoms_out)))
                 gdf_links = gpd.GeoDataFrame({"id": ids}, geometry=geoms_out, crs="EPSG:3857")
                 gdf_links = gdf_links.to_crs(epsg=4326)
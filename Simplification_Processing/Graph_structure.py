@@ -1,12 +1,40 @@
 from tqdm import tqdm
+import numpy as np
+import shapely
 from geometry_processing import *
 from Angle import *
 from copy import deepcopy
+from functools import partial
+import heapq
 from data_structure import *
+from geometry_store import LinkGeometryStore, NodeGeometryStore, LinkList
 from data_input import *
 
 class GraphBuilder:
-    def __init__(self, link_storage, link, node, node_storage, filename):
+    def __init__(self, link_storage, link, node, node_storage, filename, workers=1, compact=False,
+                 packed_geometry=False, compaction=False, grid_size=None):
+        #   compact: keep link/node in array-backed CompactTopology rows; self.link and self.node are then
+        #   dict-of-sets views over it. Much less memory, the results can differ slightly (see CompactTopology)
+        self.topology = None
+        if compact:
+            self.topology = CompactTopology.from_dicts(link, node)
+            link, node = self.topology.link, self.topology.node
+        #   grid_size: precision grid (CRS units, e.g. 0.01 for 1 cm in EPSG:3857). The input coordinates are
+        #   snapped to it here and the endpoint tests compare their integer grid keys (see pt_gap); None keeps
+        #   the float distances
+        self.grid_size = grid_size
+        if grid_size is not None:
+            link_storage = snap_to_grid(link_storage, grid_size)
+            node_storage = snap_to_grid(node_storage, grid_size)
+        #   packed_geometry: keep link/node geometries in coordinate buffers (geometry_store) instead of lists
+        #   of shapely objects
+        if packed_geometry:
+            link_storage = LinkGeometryStore.from_geoms(link_storage)
+            node_storage = NodeGeometryStore.from_geoms(node_storage)
+        elif not isinstance(link_storage, LinkList):
+            link_storage = LinkList(link_storage)
+        #   length and end coordinates of every link, kept in step with link_storage
+        self.link_attr = link_storage.attrs
         self.link_storage = link_storage
         self.link = link
         self.node = node
@@ -14,28 +42,199 @@ class GraphBuilder:
         self.crossing_management = dict()
         self.merging_dict = dict()
         self.merging_storage = list()
+        #   union-find of the merging groups while they are built, materialized into the two above
+        self.merge_groups = MergeGroups()
+        #   node pair -> shortest link index (LinkPairIndex), kept from the cycle search to the end of
+        #   run_cycle_simplify, whose graph changes all go through add_links, del_links, update_replacing_node
+        #   and update_change_node_geom. None in the other stages, links_between then intersects the node sets
+        self.link_pairs = None
+        #   search state reused by every explore_roads call
+        self.path_search = ShortestPathSearch()
         self.prev_merging_dict = dict()
         self.prev_merging_stg= list()
         self.filename = filename
+        self.workers = workers  # processes for the geometric splitting in graph_establishment
+        #   compaction: renumber links and nodes densely between the stages of run (see compact_storage).
+        #   The result can differ from a run without it
+        self.compaction = compaction
+        self.id_remaps = list()
+        #   every write to link, node, link_storage and node_storage (see track_changes). check_graph_validation,
+        #   combine_pass_links and short_stats read the changes they need from their subscriptions in subs
+        self.journal = ChangeJournal()
+        self.subs = dict()
+        self.node_registry = NodeRegistry(tolerance=1)
+        for n_idx, n_geom in enumerate(self.node_storage):
+            if n_geom is not None:
+                self.node_registry.insert(n_idx, n_geom.x, n_geom.y)
+        #   ids of the links/nodes check_graph_validation still has to revisit, on top of the unread events
+        #   of its subscriptions
+        self.dirty_links = set()
+        self.dirty_nodes = set()
+        #   True until combine_pass_links has visited every node once
+        self.pass_sweep = True
+        #   2-hop neighbourhood length statistics of remove_anomalous_shortlinks, kept across its passes
+        self.short_stats = None
+        self.track_changes()
+
+    def track_changes(self):
+        '''
+        record the writes to link, node and link_storage in the journal and start its consumers afresh: every
+        link and node is dirty, the next combine_pass_links visits every node and short_stats is empty
+        '''
+        for sub in self.subs.values():
+            self.journal.unsubscribe(sub)
+        self.subs = {'link_checks': self.journal.subscribe(('link', 'link_geom')),
+                     'node_checks': self.journal.subscribe(('node',)),
+                     'pass': self.journal.subscribe(('node', 'link_geom')),
+                     'short': self.journal.subscribe(('link', 'node', 'link_geom'))}
+        self.dirty_links = set(range(len(self.link_storage)))
+        self.dirty_nodes = set(range(len(self.node_storage)))
+        self.pass_sweep = True
+        self.short_stats = NeighbourhoodStats(self.link_attr)
+        if self.topology is not None:
+            self.topology.links.on_change = partial(self.journal.record, 'link')
+            self.topology.nodes.on_change = partial(self.journal.record, 'node')
+        else:
+            self.link = TrackedDict(self.link, on_change=partial(self.journal.record, 'link'))
+            self.node = TrackedDict(self.node, on_change=partial(self.journal.record, 'node'))
+        self.link_attr.on_change = partial(self.journal.record, 'link_geom')
+
+    #   in-place changes of the link/node sets go through these, which report them (TrackedDict.touch):
+    #   only writes mark a link or node changed
+    def add_link_to_node(self, n_idx, l_idx):
+        self.node[n_idx].add(l_idx)
+        self.node.touch(n_idx)
+
+    def remove_link_from_node(self, n_idx, l_idx):
+        self.node[n_idx].discard(l_idx)
+        self.node.touch(n_idx)
+
+    def add_node_to_link(self, l_idx, n_idx):
+        self.link[l_idx].add(n_idx)
+        self.link.touch(l_idx)
+
+    def remove_node_from_link(self, l_idx, n_idx):
+        self.link[l_idx].discard(n_idx)
+        self.link.touch(l_idx)
+
+    def pop_node_from_link(self, l_idx):
+        n_idx = self.link[l_idx].pop()
+        self.link.touch(l_idx)
+        return n_idx
     
     def save(self):
         save_testingFile(self.link_storage, self.filename+ 'links')
         save_testingFile(self.node_storage, self.filename + 'nodes')
         save_data_structure(self.link, self.filename + "Graph_links.pkl")
         save_data_structure(self.node, self.filename + "Graph_node.pkl")
+        if self.id_remaps:
+            save_data_structure({'link': self.original_ids('link'), 'node': self.original_ids('node'),
+                                 'remaps': self.id_remaps}, self.filename + "Graph_remap.pkl")
+
+    def compact_storage(self):
+        '''
+        Drop the None slots of link_storage and node_storage and renumber the live links and nodes densely,
+        keeping their relative order. link, node, crossing_management, merging_dict, merging_storage and the
+        prev_merging ones are rewritten with the new ids. Dead links still named by the merging groups get
+        the unique negative id -1 - old_id, so they keep comparing unequal to every live link.
+        The old ids are recorded in self.id_remaps: after the k-th compaction, new id i was id_remaps[k][kind][i].
+        The passes visit links and nodes in the iteration order of these sets, which follows the id values:
+        after a renumbering some ties (which of two links to merge first, which duplicate to keep) go the other
+        way, so the result can differ from a run without compaction
+        :return: link_map, node_map: arrays old id -> new id (-1 for dropped ids)
+        '''
+        live_links = np.array([l for l in range(len(self.link_storage)) if self.link_storage[l] is not None],
+                              dtype=np.int64)
+        live_nodes = np.array([n for n in range(len(self.node_storage)) if self.node_storage[n] is not None],
+                              dtype=np.int64)
+        link_map = np.full(len(self.link_storage), -1, dtype=np.int64)
+        link_map[live_links] = np.arange(len(live_links))
+        node_map = np.full(len(self.node_storage), -1, dtype=np.int64)
+        node_map[live_nodes] = np.arange(len(live_nodes))
+        link_map_l, node_map_l = link_map.tolist(), node_map.tolist()
+
+        def new_link_id(l):
+            return link_map_l[l] if 0 <= l < len(link_map_l) and link_map_l[l] >= 0 else -1 - l
+
+        def remap_set(ids, id_map):
+            return None if ids is None else {id_map[i] for i in ids if id_map[i] >= 0}
+
+        link = {link_map_l[l]: remap_set(n_set, node_map_l) for l, n_set in self.link.items()
+                if l < len(link_map_l) and link_map_l[l] >= 0}
+        node = {node_map_l[n]: remap_set(l_set, link_map_l) for n, l_set in self.node.items()
+                if n < len(node_map_l) and node_map_l[n] >= 0}
+        if self.topology is not None:
+            self.topology = CompactTopology.from_dicts(link, node)
+            link, node = self.topology.link, self.topology.node
+        self.link, self.node = link, node
+
+        self.link_storage = self.link_storage.take(live_links)
+        self.link_attr = self.link_storage.attrs
+        if isinstance(self.node_storage, NodeGeometryStore):
+            self.node_storage = self.node_storage.take(live_nodes)
+        else:
+            self.node_storage = [self.node_storage[n] for n in live_nodes]
+        self.node_registry = NodeRegistry(tolerance=1)
+        for n_idx, n_geom in enumerate(self.node_storage):
+            self.node_registry.insert(n_idx, n_geom.x, n_geom.y)
+
+        self.crossing_management = {link_map_l[l]: [node_map_l[n] for n in nds if node_map_l[n] >= 0]
+                                    for l, nds in self.crossing_management.items() if link_map_l[l] >= 0}
+        self.merging_dict = {new_link_id(l): g for l, g in self.merging_dict.items()}
+        self.merging_storage = [None if g is None else {new_link_id(l) for l in g} for g in self.merging_storage]
+        self.prev_merging_dict = {new_link_id(l): g for l, g in self.prev_merging_dict.items()}
+        self.prev_merging_stg = [None if g is None else {new_link_id(l) for l in g} for g in self.prev_merging_stg]
+        self.id_remaps.append({'link': live_links, 'node': live_nodes})
+        self.track_changes()
+        return link_map, node_map
+
+    def original_ids(self, kind='link'):
+        '''
+        trace the current ids back through every compaction
+        :param kind: 'link' or 'node'
+        :return: array current id -> id before the first compaction, -1 for ids created after a compaction
+        '''
+        storage = self.link_storage if kind == 'link' else self.node_storage
+        ids = np.arange(len(storage))
+        for remap in reversed(self.id_remaps):
+            old = remap[kind]
+            known = (ids >= 0) & (ids < len(old))
+            ids = np.where(known, old[np.where(known, ids, 0)] if len(old) else -1, -1)
+        return ids
     
-    def run(self):
-        self.graph_connections()
-        self.graph_establishment()
+    def add_node_geom(self, geom):
+        '''
+        append a node geometry to node_storage and register it for snapping
+        :return: the new node id
+        '''
+        n_idx = len(self.node_storage)
+        self.node_storage.append(geom)
+        self.node_registry.insert(n_idx, geom.x, geom.y)
+        self.journal.record('node_geom', n_idx)
+        return n_idx
+
+    def del_node_geom(self, n_idx):
+        self.node_storage[n_idx] = None
+        self.node_registry.remove(n_idx)
+        self.journal.record('node_geom', n_idx)
+
+    def run(self, noded=False):
+        '''
+        :param noded: True when link/node/node_storage were given already noded (noding.build_topology),
+                      then graph_connections and graph_establishment are skipped
+        '''
+        if not noded:
+            self.graph_connections()
+            self.graph_establishment()
         
         times = len(self.link_storage)
+        simplified = simplify_lines([self.link_storage[i] for i in range(times)])
         for i in tqdm(range(times)):
             if self.link_storage[i] is None:
                 continue
-            self.run_linesimplification(i)
+            self.run_linesimplification(i, simplified[i])
         
-        for node_id, node_set in tqdm(self.node.items()):
-            self.run_Combine_PassLinks(node_id, node_set)
+        self.combine_pass_links()
         
         for link_id in tqdm(range(len(self.link_storage))):
             if self.link_storage[link_id] is None:
@@ -43,105 +242,98 @@ class GraphBuilder:
             if len(self.link[link_id]) == 0:
                 self.link_storage[link_id] = None
                 if len(self.link[link_id]) > 0:
-                    kept = self.link[link_id].pop()
+                    kept = self.pop_node_from_link(link_id)
                     for nd in self.link[link_id]:
                         self.node[kept] = self.node[kept].union(self.node[nd])
                         self.node.pop(nd)
-                        self.node_storage[nd] = None
-                    self.node[kept].discard(link_id)
+                        self.del_node_geom(nd)
+                    self.remove_link_from_node(kept, link_id)
                 self.link.pop(link_id)
         
-        for l, n in tqdm(self.link.items()):
-            if not self.link_storage[l]:
-                continue
-            self.run_remove_anomalous_shortlinks(l, n)
+        self.remove_anomalous_shortlinks()
         self.check_graph_validation()
+        if self.compaction:
+            self.compact_storage()
 
+        modified = modify_lines([self.link_storage[i] for i in range(len(self.link_storage))])
         for i in tqdm(range(len(self.link_storage))):
             if self.link_storage[i] is not None:
-                self.link_storage[i] = LineModification(self.link_storage[i])
+                self.link_storage[i] = modified[i]
 
-        for val, items in tqdm(self.node.items()):
-            self.run_IdentifyParrallelCrossing(val, items)
+        self.merge_groups = MergeGroups()
+        self.identify_parallel_crossings()
 
+        self.link_pairs = LinkPairIndex.from_links(self.link, self.link_attr)
         times = 0
-        while times < len(self.merging_storage):
-            if self.merging_storage[times] is None:
+        while times < self.merge_groups.n_slots:
+            if not self.merge_groups.alive(times):
                 times += 1
                 continue
             self.run_find_close_cycles_on_graph(times)
             times += 1
+        self.merging_dict, self.merging_storage = self.merge_groups.materialize()
 
-        self.prev_merging_dict = deepcopy(self.merging_dict)
-        self.prev_merging_stg = deepcopy(self.merging_storage)
+        #   merge_groups materializes new objects every round and run_cycle_simplify only clears slots of
+        #   merging_storage, so the snapshot shares the dict and the group sets
+        self.prev_merging_dict = self.merging_dict
+        self.prev_merging_stg = list(self.merging_storage)
         self.run_cycle_simplify()
+        self.link_pairs = None
 
         self.run_finishing()
         
     def run_finishing(self, looptimes=0):
         print("Currently in {} times".format(looptimes))
+        if self.compaction:
+            self.compact_storage()
         print("run_Combine_PassLinks in {} time".format(looptimes))
-        for n_idx, link_set in tqdm(self.node.items()):
-            self.run_Combine_PassLinks(n_idx, link_set)
+        self.combine_pass_links()
 
         self.check_graph_validation()
 
         print("run_remove_anomalous_shortlinks in {} time".format(looptimes))
-        for l, n in tqdm(self.link.items()):
-            if self.link_storage[l] is None:
-                continue
-            self.run_remove_anomalous_shortlinks(l, n)
+        self.remove_anomalous_shortlinks()
         self.check_graph_validation()
         print("run_IdentifyParrallelCrossing in {} time".format(looptimes))
-        self.merging_dict = dict()
-        self.merging_storage = list()
-        for n_idx, link_set in tqdm(self.node.items()):
-            self.run_IdentifyParrallelCrossing(n_idx, link_set)
+        self.merge_groups = MergeGroups()
+        self.identify_parallel_crossings()
 
         print("run_find_close_cycles_on_graph in {} time".format(looptimes))
+        self.link_pairs = LinkPairIndex.from_links(self.link, self.link_attr)
         times = 0
-        while times < len(self.merging_storage):
-            if self.merging_storage[times] is None:
+        while times < self.merge_groups.n_slots:
+            if not self.merge_groups.alive(times):
                 times += 1
                 continue
             self.run_find_close_cycles_on_graph(times)
             times += 1
+        self.merging_dict, self.merging_storage = self.merge_groups.materialize()
 
         update_status = self.Identify_MergingDifference(self.prev_merging_dict, 
                                                         self.prev_merging_stg, 
                                                         self.merging_dict, 
                                                         self.merging_storage)
         if update_status:
-            self.prev_merging_dict = deepcopy(self.merging_dict)
-            self.prev_merging_stg = deepcopy(self.merging_storage)
+            self.prev_merging_dict = self.merging_dict
+            self.prev_merging_stg = list(self.merging_storage)
             print("run_cycle_simplify in {} time".format(looptimes))
             self.run_cycle_simplify()
+            self.link_pairs = None
             self.run_finishing( looptimes + 1)
         else:
+            self.link_pairs = None
             return
     
     def run_graph_establishment(self):
-        for l, nd_set in self.crossing_management.items():
-            spt_list = nodes_split_curve([self.node_storage[i] for i in nd_set], self.link_storage[l])
-            add_idx = list()
-            for i in spt_list:
-                current_index = len(self.link_storage)
-                add_idx.append(current_index)
-                self.link_storage.append(i)
-                self.link[current_index] = set()
-            self.link_storage[l] = None
-            for relate_nd in self.link[l]:
-                for relate_li in add_idx:
-                    if check_endpt(self.node_storage[relate_nd], self.link_storage[relate_li]):
-                        self.node[relate_nd].add(relate_li)
-                        self.link[relate_li].add(relate_nd)
-                self.node[relate_nd].remove(l)
-                if l in self.node[relate_nd]:
-                    raise ValueError("unfound related links")
-            self.link.pop(l)
+        self.graph_establishment()
     
-    def run_linesimplification(self, link_id):
-        spt_list, spt_node, nd2li, status = LineSimplication(self.link_storage[link_id], link_id)
+    def run_linesimplification(self, link_id, simplified=None):
+        '''
+        :param simplified: the LineSimplication result of the link when already computed (simplify_lines)
+        '''
+        if simplified is None:
+            simplified = LineSimplication(self.link_storage[link_id], link_id)
+        spt_list, spt_node, nd2li, status = simplified
         if not status:
             return
         if len(spt_list) == 1:
@@ -152,7 +344,7 @@ class GraphBuilder:
         dup_record = dict()
         #   检测有没有被纪录过
         for nd in related_nd:
-            self.node[nd].remove(link_id)
+            self.remove_link_from_node(nd, link_id)
         for nd_idx in range(len(spt_node)):
             li_set = nd2li[nd_idx]
             current_node = spt_node[nd_idx]
@@ -165,25 +357,26 @@ class GraphBuilder:
                 li = list(li_set)[0]
                 for nd in related_nd:
                     #   nd is the index of self.node_storage
-                    if current_node.distance(self.node_storage[nd]) < 1:
+                    nd_geom = self.node_storage[nd]
+                    if pt_gap((current_node.x, current_node.y), (nd_geom.x, nd_geom.y), self.grid_size) < 1:
                         #   the current node and the original node are the same point
                         if li not in dup_record:
                             #   li is traversed for the first time
                             current_lidx = len(self.link_storage)
                             dup_record[li] = current_lidx
                             self.link[current_lidx] = {nd}
-                            self.node[nd].add(current_lidx)
+                            self.add_link_to_node(nd, current_lidx)
                             self.link_storage.append(spt_list[li])
                         else:
                             #   li was traversed before
                             current_lidx = dup_record[li]
-                            self.link[current_lidx].add(nd)
-                            self.node[nd].add(current_lidx)
+                            self.add_node_to_link(current_lidx, nd)
+                            self.add_link_to_node(nd, current_lidx)
                         break
             else:
                 #   this is the intermediate and new established pt
                 self.node[current_nidx] = set()
-                self.node_storage.append(current_node)
+                self.add_node_geom(current_node)
                 for li in li_set:
                     #   li is the index of spt_list
                     if li not in dup_record:
@@ -191,71 +384,150 @@ class GraphBuilder:
                         current_lidx = len(self.link_storage)
                         dup_record[li] = current_lidx
                         self.link[current_lidx] = {current_nidx}
-                        self.node[current_nidx].add(current_lidx)
+                        self.add_link_to_node(current_nidx, current_lidx)
                         self.link_storage.append(spt_list[li])
                     else:
                         #   li was traversed before
                         current_lidx = dup_record[li]
-                        self.link[current_lidx].add(current_nidx)
-                        self.node[current_nidx].add(current_lidx)
+                        self.add_node_to_link(current_lidx, current_nidx)
+                        self.add_link_to_node(current_nidx, current_lidx)
 
-    def run_Combine_PassLinks(self, n_idx, n_set):
+    def combine_pass_links(self):
+        '''
+        run_Combine_PassLinks on the nodes that changed since the last pass (the nodes written and the end
+        nodes of the links reshaped, read from the journal; every node on the first pass), in id order: the
+        others keep the links and the geometries they failed the angle rule with. A chain of merges at
+        consecutive degree-2 nodes is joined as a LinkChain and every merged link is built once at the end
+        of the pass
+        '''
+        work = set(range(len(self.node_storage))) if self.pass_sweep else set()
+        self.pass_sweep = False
+        for e in self.journal.poll(self.subs['pass']):
+            if e.kind == 'node':
+                work.add(e.id)
+                continue
+            nodes = self.link.get(e.id)
+            if nodes:
+                work.update(nodes)
+        chains = dict()
+        for n_idx in tqdm(sorted(work)):
+            self.run_Combine_PassLinks(n_idx, self.node.get(n_idx), chains)
+        if not chains:
+            return
+        ids = list(chains)
+        coords = [chains[l].coords() for l in ids]
+        new_links = shapely.linestrings(np.concatenate(coords),
+                                        indices=np.repeat(np.arange(len(ids)), [len(c) for c in coords]))
+        for l, geom in zip(ids, new_links.tolist()):
+            self.link_storage[l] = geom
+
+    def pass_chain(self, l_id, chains):
+        chain = chains.get(l_id)
+        if chain is None:
+            chain = LinkChain(self.link_storage.coords(l_id))
+        return chain
+
+    def run_Combine_PassLinks(self, n_idx, n_set, chains):
+        '''
+        merge the two links of a degree-2 node n_idx when they go on straight enough (|cosine| > 0.6).
+        The merged link gets a new id and its geometry is left in chains (new id -> LinkChain) for
+        combine_pass_links to build, link_storage holds None for it until then
+        '''
         if n_set is None:
             return
         if len(n_set) == 2:
             li = list(n_set)
-            angle = abs(AngleCal(self.link_storage[li[0]], self.link_storage[li[1]]))
+            c1, c2 = self.pass_chain(li[0], chains), self.pass_chain(li[1], chains)
+            angle = abs(AngleCal_ends(c1.start, c1.end, c2.start, c2.end))
             if angle > 0.6:
-                new_link = CombinePassLinks(self.link_storage[li[0]], self.link_storage[li[1]])
+                swap, rev1, rev2 = pass_links_order(c1.start, c1.end, c2.start, self.grid_size)
+                if rev1:
+                    c1.reverse()
+                if rev2:
+                    c2.reverse()
                 idx = len(self.link_storage)
+                chains[idx] = LinkChain.join(c2, c1) if swap else LinkChain.join(c1, c2)
                 new_node = set()
-                self.link_storage.append(new_link)
+                self.link_storage.append(None)
                 for l in n_set:
-                    self.link[l].discard(n_idx)
+                    chains.pop(l, None)
+                    self.remove_node_from_link(l, n_idx)
                     new_node = new_node.union(self.link[l])
                     self.link_storage[l] = None
                     for n in self.link[l]:
-                        self.node[n].discard(l)
-                        self.node[n].add(idx)
+                        self.remove_link_from_node(n, l)
+                        self.add_link_to_node(n, idx)
                     self.link[l] = None
                 self.link[idx] = new_node
                 self.node[n_idx] = None
-                self.node_storage[n_idx] = None
+                self.del_node_geom(n_idx)
+
+    def remove_anomalous_shortlinks(self, length_limits=50):
+        '''
+        run_remove_anomalous_shortlinks on the links shorter than length_limits, shortest first (ties by id).
+        The links reshaped by a removal are queued again with their new lengths
+        '''
+        lengths = self.link_attr.length[:len(self.link_storage)]
+        short = np.nonzero(lengths < length_limits)[0]
+        heap = list(zip(lengths[short].tolist(), short.tolist()))
+        heapq.heapify(heap)
+        with tqdm(total=len(heap)) as bar:
+            while heap:
+                length, l_idx = heapq.heappop(heap)
+                bar.update()
+                n_set = self.link.get(l_idx)
+                if n_set is None or self.link_attr.length[l_idx] != length:
+                    #   removed (nan length), or queued again with its new length
+                    continue
+                for l in self.run_remove_anomalous_shortlinks(l_idx, n_set, length_limits):
+                    if self.link_attr.length[l] < length_limits:
+                        heapq.heappush(heap, (float(self.link_attr.length[l]), l))
+                        bar.total += 1
+
+    def link_neighbourhood(self, l_idx):
+        '''
+        :return: the links within 2 hops of l_idx, and the links and nodes whose connectivity was read to
+                 find them
+        '''
+        depth1, depth_end1 = self.Line_forward_Line(l_idx)
+        depth2, _ = self.Line_forward_Line(depth1, depth_end1)
+        nodes = set(self.link[l_idx])
+        for l in depth1:
+            nodes.update(self.link[l])
+        return depth2 + depth1, depth1 + [l_idx], nodes
 
     def run_remove_anomalous_shortlinks(self, l_idx, n_set, length_limits=50):
-        if self.link_storage[l_idx].length < length_limits:
-            depth1, depth_end1 = self.Line_forward_Line(l_idx)
-            depth2, _ = self.Line_forward_Line(depth1, depth_end1)
-            related_li = depth2 + depth1
-            length_record = list()
-            for li_geo_idx in related_li:
-                length_record.append(self.link_storage[li_geo_idx].length)
-            if len(length_record) == 0:
-                return
-            q1, q3 = np.percentile(length_record, [33, 75])
-            meanlength = np.mean(length_record)
-            if (meanlength / self.link_storage[l_idx].length > 4) and (self.link_storage[l_idx].length < q1):
+        '''
+        collapse l_idx to its mid point when it is much shorter than the links within 2 hops of it
+        :return: the links reshaped by the collapse, empty if l_idx was kept
+        '''
+        if self.link_attr.length[l_idx] < length_limits:
+            self.short_stats.invalidate(self.journal.poll(self.subs['short']))
+            stats = self.short_stats.get(l_idx, self.link_neighbourhood)
+            if stats is None:
+                return ()
+            meanlength, q1 = stats
+            if (meanlength / self.link_attr.length[l_idx] > 4) and (self.link_attr.length[l_idx] < q1):
                 #   abnormal too short link identification and aggregation.
-                pt_idx = len(self.node_storage)
                 #   aggregating at their centroid
-                new_pt = midPt(self.link_storage[l_idx])
-                self.node_storage.append(new_pt)
+                new_pt = Point((self.link_attr.ends[l_idx, 1] + self.link_attr.ends[l_idx, 0]) / 2)
+                pt_idx = self.add_node_geom(new_pt)
                 new_node = set()
                 for i in n_set:
-                    self.node[i].discard(l_idx)
+                    self.remove_link_from_node(i, l_idx)
                     new_node = new_node.union(self.node[i])
                     self.node.pop(i)
-                    self.node_storage[i] = None
+                    self.del_node_geom(i)
                 self.node[pt_idx] = new_node
                 # modify relevant links
                 for fixline in new_node:
                     # geometric information update
                     l1 = self.link_storage[fixline]
-                    if l1.length == 0:
+                    if self.link_attr.length[fixline] == 0:
                         self.link_storage[fixline] = None
                         if fixline in self.link:
                             for n in self.link[fixline]:
-                                self.node[n].discard(fixline)
+                                self.remove_link_from_node(n, fixline)
                             self.link.pop(fixline)
                         continue
                     if l1 is None:
@@ -304,58 +576,70 @@ class GraphBuilder:
                     self.link_storage[fixline] = LineString(l1_list)
                     #   Graph connectivity update
                     self.link[fixline] = self.link[fixline] - n_set
-                    self.link[fixline].add(pt_idx)
+                    self.add_node_to_link(fixline, pt_idx)
                 self.link[l_idx] = None
                 self.link_storage[l_idx] = None
+                return new_node
+        return ()
 
-    def run_IdentifyParrallelCrossing(self, n_idx, n_set):
-        if n_set is None:
+    def junction_bearings(self, nodes, loops):
+        '''
+        unit vectors along the chords of the links of every node, pointing away from the node: the link end
+        within 1 of the node is taken as the one at the node (nan for a closed link)
+        :param nodes: node ids
+        :param loops: the link lists of the nodes
+        :return: (sum of the loop lengths, 2) array, the rows of nodes[k] following those of nodes[k - 1]
+        '''
+        pts = np.empty(len(nodes), dtype=object)
+        pts[:] = [self.node_storage[n] for n in nodes]
+        node_xy = shapely.get_coordinates(pts)
+        inc_link = np.fromiter((l for loop in loops for l in loop), dtype=np.int64)
+        inc_node = np.repeat(np.arange(len(nodes)), [len(loop) for loop in loops])
+        start, end = self.link_attr.ends[inc_link, 0], self.link_attr.ends[inc_link, 1]
+        flip = pt_distances(start, node_xy[inc_node], self.grid_size) > 1
+        out = np.where(flip[:, None], start - end, end - start)
+        length = np.sqrt(out[:, 0] * out[:, 0] + out[:, 1] * out[:, 1])[:, None]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(length > 0, out / length, np.nan)
+
+    def identify_parallel_crossings(self):
+        '''
+        run_IdentifyParrallelCrossing of every node with two links or more, the bearings of all of them
+        computed at once by junction_bearings
+        '''
+        nodes, loops = list(), list()
+        for n_idx, n_set in self.node.items():
+            if n_set is not None and len(n_set) > 1:
+                nodes.append(n_idx)
+                loops.append(list(n_set))
+        if not nodes:
             return
-        loop = list(n_set)
-        for l1 in range(len(loop)):
-            for l2 in range(l1 + 1, len(loop)):
-                # ensuring the pt sequence from junctions
-                t1 = [Point(self.link_storage[loop[l1]].xy[0][0], self.link_storage[loop[l1]].xy[1][0]),
-                      Point(self.link_storage[loop[l1]].xy[0][-1], self.link_storage[loop[l1]].xy[1][-1])]
-                t2 = [Point(self.link_storage[loop[l2]].xy[0][0], self.link_storage[loop[l2]].xy[1][0]),
-                      Point(self.link_storage[loop[l2]].xy[0][-1], self.link_storage[loop[l2]].xy[1][-1])]
-                if t1[0].distance(self.node_storage[n_idx]) > 1:
-                    t1.reverse()
-                if t2[0].distance(self.node_storage[n_idx]) > 1:
-                    t2.reverse()
-                angle = AngleCal(LineString(t1), LineString(t2))
-                if angle > 0.9:
-                    if (loop[l1] in self.merging_dict.keys()) and (loop[l2] in self.merging_dict.keys()):
-                        idx = len(self.merging_storage)
-                        self.merging_storage.append(
-                            self.merging_storage[self.merging_dict[loop[l1]]].union(
-                                self.merging_storage[self.merging_dict[loop[l2]]]))
-                        self.merging_storage[self.merging_dict[loop[l1]]] = None
-                        self.merging_storage[self.merging_dict[loop[l2]]] = None
-                        for i in self.merging_storage[-1]:
-                            self.merging_dict[i] = idx
-                    elif loop[l1] in self.merging_dict.keys():
-                        self.merging_dict[loop[l2]] = self.merging_dict[loop[l1]]
-                        self.merging_storage[self.merging_dict[loop[l1]]].add(loop[l2])
-                    elif loop[l2] in self.merging_dict.keys():
-                        self.merging_dict[loop[l1]] = self.merging_dict[loop[l2]]
-                        self.merging_storage[self.merging_dict[loop[l2]]].add(loop[l1])
-                    else:
-                        self.merging_dict[loop[l1]] = len(self.merging_storage)
-                        self.merging_dict[loop[l2]] = len(self.merging_storage)
-                        self.merging_storage.append({loop[l1], loop[l2]})
+        bearings = self.junction_bearings(nodes, loops)
+        first = 0
+        for n_idx, loop in tqdm(zip(nodes, loops), total=len(nodes)):
+            self.run_IdentifyParrallelCrossing(n_idx, loop, bearings[first: first + len(loop)])
+            first += len(loop)
+
+    def run_IdentifyParrallelCrossing(self, n_idx, loop, bearings):
+        '''
+        the links of node n_idx leaving it in nearly the same direction (cosine > 0.9) go to the merge groups
+        :param loop: the links of n_idx
+        :param bearings: unit chords of the links of loop, pointing away from n_idx (junction_bearings)
+        '''
+        with np.errstate(invalid='ignore'):
+            close = np.triu(bearings @ bearings.T > 0.9, 1)
+        for l1, l2 in zip(*np.nonzero(close)):
+            self.merge_groups.add_pair(loop[l1], loop[l2])
 
     def run_find_close_cycles_on_graph(self, storage_id):
-        li_set = self.merging_storage[storage_id].copy()
+        groups = self.merge_groups
+        li_set = groups.members(storage_id)
         pts_status, brk_pts = self.check_breaknd(li_set)
         if len(brk_pts) == 0:
             return
         while brk_pts:
-            n = brk_pts.pop()
-            if pts_status[n]['status'] != 'breaknd':
-                continue
-
-            path_list, pts_status, brk_pts = self.explore_roads(n, pts_status, brk_end=brk_pts)
+            #   one search from all the break nodes left; check_breaknd adds those of groups joined below
+            path_list, pts_status, brk_pts = self.explore_roads(pts_status, brk_end=brk_pts)
             #   Status indicates whether other merging groups have been found.
             #   If so, update the status and update the pts_status and brk_pts that need to be found
             status = 0
@@ -366,19 +650,12 @@ class GraphBuilder:
                     newlinks = self.nodeseq_to_linkseq(path)
                     li_set = li_set.union(newlinks)
                     for i in newlinks:
-                        if i in self.merging_dict:
+                        if i in groups:
                             #   this cycle is twisted with other cycles
                             status = 1
-                            li_set = self.merging_storage[self.merging_dict[i]].union(li_set)
-                    self.merging_storage[storage_id] = li_set
-                    for i in li_set:
-                        if i not in self.merging_dict:
-                            #   i is a new founded link in cycles
-                            self.merging_dict[i] = storage_id
-                        elif self.merging_dict[i] != storage_id:
-                            #   i is also part of other cycles
-                            self.merging_storage[self.merging_dict[i]] = None
-                            self.merging_dict[i] = storage_id
+                            li_set = li_set.union(groups.members(groups.slot_of(i)))
+                    #   the new links and the groups they belong to join the group of storage_id
+                    groups.absorb(storage_id, newlinks)
             if status:
                 pts_status, brk_pts = self.check_breaknd(li_set, pts_status, brk_pts)
 
@@ -411,8 +688,17 @@ class GraphBuilder:
             self.merging_storage[idx] = None
 
     def graph_establishment(self):
-        for l, nd_set in self.crossing_management.items():
-            spt_list = nodes_split_curve([self.node_storage[i] for i in nd_set], self.link_storage[l])
+        '''
+        split every link of crossing_management at its crossing nodes.
+        The splitting is independent per link and runs in parallel batches (self.workers);
+        the topology merge below then applies the pieces in crossing_management order
+        '''
+        cross_links = list(self.crossing_management.keys())
+        spt_lists = split_lines_at_points([self.link_storage[l] for l in cross_links],
+                                          [[self.node_storage[i] for i in self.crossing_management[l]]
+                                           for l in cross_links],
+                                          workers=self.workers)
+        for l, spt_list in zip(cross_links, spt_lists):
             add_idx = list()
             for i in spt_list:
                 current_index = len(self.link_storage)
@@ -422,10 +708,10 @@ class GraphBuilder:
             self.link_storage[l] = None
             for relate_nd in self.link[l]:
                 for relate_li in add_idx:
-                    if check_endpt(self.node_storage[relate_nd], self.link_storage[relate_li]):
-                        self.node[relate_nd].add(relate_li)
-                        self.link[relate_li].add(relate_nd)
-                self.node[relate_nd].remove(l)
+                    if self.link_ends_near(relate_li, self.node_storage[relate_nd]):
+                        self.add_link_to_node(relate_nd, relate_li)
+                        self.add_node_to_link(relate_li, relate_nd)
+                self.remove_link_from_node(relate_nd, l)
                 if l in self.node[relate_nd]:
                     raise ValueError("未知错误：未找到继承关系线")
             self.link.pop(l)
@@ -443,40 +729,45 @@ class GraphBuilder:
     def graph_connections(self):
         crossing_management = dict()
         pt_idx = [0, 0]
-        for o in tqdm(range(len(self.link_storage))):
-            for d in range(o + 1, len(self.link_storage)):
-                line1 = self.link_storage[o]
-                line2 = self.link_storage[d]
-
-                if o not in self.link.keys():
-                    self.link[o] = set()
-                if d not in self.link.keys():
-                    self.link[d] = set()
-                if pt_idx[0] not in self.node.keys():
-                    self.node[pt_idx[0]] = set()
-
-                if line1.intersects(line2):
-                    intersectionGEOM = line1.intersection(line2)
-                    if intersectionGEOM.type == 'Point':
-                        crossing_management, pt_idx = self.intersection_of_pt(intersectionGEOM, crossing_management, pt_idx,
-                                                                         o, d)
-                    elif intersectionGEOM.type == 'MultiPoint':
-                        crossing_management, pt_idx = self.intersection_of_multipt(intersectionGEOM, crossing_management,
-                                                                              pt_idx,
-                                                                              o, d)
-                    elif intersectionGEOM.type == "LineString":
-                        crossing_management, pt_idx = self.intersection_of_line(intersectionGEOM, crossing_management,
+        geoms = np.array(self.link_storage, dtype=object)
+        for o in range(len(geoms)):
+            if o not in self.link.keys():
+                self.link[o] = set()
+        #   candidate pairs come from one bulk STRtree query instead of testing every pair of links.
+        #   Only o < d is kept and pairs are visited in the (o, d) order of the former double loop,
+        #   so node ids and node snapping stay identical.
+        tree = shapely.STRtree(geoms)
+        src, dst = tree.query(geoms, predicate="intersects")
+        keep = src < dst
+        src, dst = src[keep], dst[keep]
+        order = np.lexsort((dst, src))
+        src, dst = src[order], dst[order]
+        intersectionGEOMS = shapely.intersection(geoms[src], geoms[dst])
+        for o, d, intersectionGEOM in tqdm(zip(src.tolist(), dst.tolist(), intersectionGEOMS), total=len(src)):
+            if pt_idx[0] not in self.node.keys():
+                self.node[pt_idx[0]] = set()
+            if intersectionGEOM.geom_type == 'Point':
+                crossing_management, pt_idx = self.intersection_of_pt(intersectionGEOM, crossing_management, pt_idx,
+                                                                      o, d)
+            elif intersectionGEOM.geom_type == 'MultiPoint':
+                crossing_management, pt_idx = self.intersection_of_multipt(intersectionGEOM, crossing_management,
                                                                            pt_idx,
                                                                            o, d)
-                    elif intersectionGEOM.type == "MultiLineString":
-                        crossing_management, pt_idx = self.intersection_of_multili(intersectionGEOM, crossing_management,
-                                                                              pt_idx,
-                                                                              o, d)
-                    elif intersectionGEOM.type == "GeometryCollection":
-                        crossing_management, pt_idx = self.intersection_of_geom_collection(intersectionGEOM,
-                                                                                      crossing_management, pt_idx, o, d)
-                    else:
-                        raise TypeError("出现预期外的交叉类型：{}".format(intersectionGEOM.type))
+            elif intersectionGEOM.geom_type == "LineString":
+                crossing_management, pt_idx = self.intersection_of_line(intersectionGEOM, crossing_management,
+                                                                        pt_idx,
+                                                                        o, d)
+            elif intersectionGEOM.geom_type == "MultiLineString":
+                crossing_management, pt_idx = self.intersection_of_multili(intersectionGEOM, crossing_management,
+                                                                           pt_idx,
+                                                                           o, d)
+            elif intersectionGEOM.geom_type == "GeometryCollection":
+                crossing_management, pt_idx = self.intersection_of_geom_collection(intersectionGEOM,
+                                                                                   crossing_management, pt_idx, o, d)
+            else:
+                raise TypeError("出现预期外的交叉类型：{}".format(intersectionGEOM.geom_type))
+        if len(geoms) > 1 and pt_idx[0] not in self.node.keys():
+            self.node[pt_idx[0]] = set()
         self.crossing_management = crossing_management
 
     def intersection_of_geom_collection(self, geom_collection, crossing_management, pt_idx, o, d):
@@ -516,24 +807,23 @@ class GraphBuilder:
 
     def intersection_of_pt(self, intersectionPT, crossing_management, pt_idx, o, d):
         new_pt = 1  # default the intersection pt is a new pt(new_pt = 1)
-        for i in range(len(self.node_storage)):
-            if self.node_storage[i].distance(intersectionPT) < 1:
-                intersectionPT = self.node_storage[i]
-                pt_idx[1] = i
-                new_pt = 0
-                break
+        snapped = self.node_registry.find(intersectionPT.x, intersectionPT.y)
+        if snapped is not None:
+            intersectionPT = self.node_storage[snapped]
+            pt_idx[1] = snapped
+            new_pt = 0
         #   check the new pt locate at end of link or mid of link
         if new_pt == 0:
-            self.node[pt_idx[1]].add(o)
-            self.node[pt_idx[1]].add(d)
-            self.link[o].add(pt_idx[1])
-            self.link[d].add(pt_idx[1])
-            if not check_endpt(intersectionPT, self.link_storage[o]):
+            self.add_link_to_node(pt_idx[1], o)
+            self.add_link_to_node(pt_idx[1], d)
+            self.add_node_to_link(o, pt_idx[1])
+            self.add_node_to_link(d, pt_idx[1])
+            if not self.link_ends_near(o, intersectionPT):
                 if o in crossing_management.keys():
                     crossing_management[o].add(pt_idx[1])
                 else:
                     crossing_management[o] = {pt_idx[1]}
-            if not check_endpt(intersectionPT, self.link_storage[d]):
+            if not self.link_ends_near(d, intersectionPT):
                 if d in crossing_management.keys():
                     crossing_management[d].add(pt_idx[1])
                 else:
@@ -541,17 +831,17 @@ class GraphBuilder:
         else:
             if pt_idx[0] not in self.node.keys():
                 self.node[pt_idx[0]] = set()
-            self.node[pt_idx[0]].add(o)
-            self.node[pt_idx[0]].add(d)
-            self.link[o].add(pt_idx[0])
-            self.link[d].add(pt_idx[0])
-            self.node_storage.append(intersectionPT)
-            if not check_endpt(intersectionPT, self.link_storage[o]):
+            self.add_link_to_node(pt_idx[0], o)
+            self.add_link_to_node(pt_idx[0], d)
+            self.add_node_to_link(o, pt_idx[0])
+            self.add_node_to_link(d, pt_idx[0])
+            self.add_node_geom(intersectionPT)
+            if not self.link_ends_near(o, intersectionPT):
                 if o in crossing_management.keys():
                     crossing_management[o].add(pt_idx[0])
                 else:
                     crossing_management[o] = {pt_idx[0]}
-            if not check_endpt(intersectionPT, self.link_storage[d]):
+            if not self.link_ends_near(d, intersectionPT):
                 if d in crossing_management.keys():
                     crossing_management[d].add(pt_idx[0])
                 else:
@@ -559,88 +849,54 @@ class GraphBuilder:
             pt_idx[0] += 1
         return crossing_management, pt_idx
 
-    def explore_roads(self, startnd, cross_status, brk_end, blockednd=None, timelimits=15):
+    def explore_roads(self, cross_status, brk_end, blockednd=None, timelimits=15):
         '''
-        一个能增量的广度优先算法
+        bounded shortest-path search from all the break nodes of brk_end at once (self.path_search): every
+        node joins the region of its nearest break node, and a link joining the regions of two break nodes
+        closes the shortest path between them, a candidate cycle when it has at most timelimits links.
+        Candidates are tried shortest first; a pair is skipped once both its break nodes closed a cycle.
+        The first step leaves the merging group, later ones may cross it.
+        cross_status and brk_end are updated in place (every break node searched from is settled) and returned
         '''
 
         if blockednd is None:
             blockednd = set()
 
-        brk_end = deepcopy(brk_end)
-        cross_status = deepcopy(cross_status)
-
-        end_positions = set(cross_status.keys()).difference(set(brk_end))
-        queue = Queue()
-        queue.Que_in(startnd)
-
-        # this dict is to record the previous li and used to find the minimal distance trace
-        # record distance from current li to startli
-        prev = {startnd: {'prev': None, 'distance': 0, 'step': 0}}
-        neighbor, _, _ = self.Node_forward_Node(startnd, self.node, self.link, end_positions)
-        currentnd = None
-        _, prevnd = self.Link_to_Node(list(cross_status[startnd]['self.links'])[0], startnd, self.link)
-        end_targets = set()
-
-        while not queue.Que_isEmpty():
-            if currentnd is None:
-                currentnd = queue.Que_out()
-                blockednd.add(currentnd)
-            elif prev[currentnd]['step'] < timelimits:
-                currentnd = queue.Que_out()
-                neighbor, _, _ = self.Node_forward_Node(currentnd, self.node, self.link, blockednd)
-            else:
-                #   search times more than the the timelimits, the serch should be stopped
-                currentnd = queue.Que_out()
-                neighbor, _, _ = self.Node_forward_Node(currentnd, self.node, self.link, blockednd)
-                continue
-
-            for nextnd in neighbor:
-                inter_li, _ = self.Link_between_Nodes(currentnd, nextnd)
-                new_distance = self.link_storage[inter_li].length + prev[currentnd]['distance']
-                if (nextnd not in blockednd):  # this nextli is first searched
-                    #   ensuring this search process wont backward
-                    prev[nextnd] = dict()
-                    prev[nextnd]['prev'] = currentnd
-                    prev[nextnd]['distance'] = new_distance
-                    prev[nextnd]['step'] = prev[currentnd]['step'] + 1
-                    blockednd.add(nextnd)
-                    if nextnd in brk_end:
-                        end_targets.add(nextnd)
-                    else:
-                        queue.Que_in(nextnd)
-
-                else:  # this nextli is searched before
-                    if new_distance < prev[nextnd]['distance']:
-                        #   it means shorter path is found
-                        prev[nextnd]['prev'] = currentnd
-                        prev[nextnd]['distance'] = new_distance
-                        prev[nextnd]['step'] = prev[currentnd]['step'] + 1
-
+        sources = [nd for nd in brk_end if cross_status[nd]['status'] == 'breaknd']
+        brk_end.clear()
         routine = list()
-        if len(end_targets) == 0:
+        if len(sources) < 2:
+            for nd in sources:
+                cross_status[nd]['status'] = 'passnd'
             return routine, cross_status, brk_end
-        for nd in end_targets:
-            path = list()
-            currentnd = nd
-            while currentnd is not None:
-                path.append(currentnd)
-                currentnd = prev[currentnd]['prev']
-            if len(path) == 0:
+        end_positions = set(cross_status.keys()).difference(sources)
+        search = self.path_search
+        search.run(sources, self.node, self.link, self.link_attr.length, len(self.node_storage),
+                   hop_limit=timelimits, blocked=blockednd, first_blocked=end_positions)
+
+        tried = set()
+        for u, v, _ in search.meetings:
+            start, end = search.origin[u], search.origin[v]
+            pair = (min(start, end), max(start, end))
+            if pair in tried:
+                continue
+            tried.add(pair)
+            if search.hops[u] + search.hops[v] >= timelimits:
                 continue
+            if cross_status[start]['status'] == cross_status[end]['status'] == 'normalnd':
+                continue
+            path = search.path(u)[::-1] + search.path(v)
             tem_path = self.find_whole_path_within_seq(path, cross_status)
             if len(tem_path) < 3:  # no cycle found
                 continue
             path_roundness = roundness(tem_path)
             if path_roundness < 0.25:
                 routine.append(path)
-                cross_status[startnd]['status'] = "normalnd"
-                cross_status[nd]['status'] = "normalnd"
-                brk_end.remove(nd)
-        if cross_status[startnd]['status'] == 'breaknd':
-            cross_status[startnd]['status'] = 'passnd'
-        if startnd in brk_end:
-            brk_end.remove(startnd)
+                cross_status[start]['status'] = "normalnd"
+                cross_status[end]['status'] = "normalnd"
+        for nd in sources:
+            if cross_status[nd]['status'] == 'breaknd':
+                cross_status[nd]['status'] = 'passnd'
         return routine, cross_status, brk_end
 
     def find_whole_path_within_seq(self, seq, cross):
@@ -681,20 +937,10 @@ class GraphBuilder:
             if currentnd == prevnd:
                 whole_path_node.append(self.node_storage[prevnd])
                 continue
-            interlink: set = self.node[prevnd].intersection(self.node[currentnd])
-            if len(interlink) > 1:
+            interlink: list = self.links_between(prevnd, currentnd)
+            if interlink:
                 #   Among intersecting links, return the shortest one
-                shortest_link = interlink.pop()
-                shortest_length = self.link_storage[shortest_link].length
-                while interlink:
-                    current_link = interlink.pop()
-                    current_length = self.link_storage[current_link].length
-                    if current_length < shortest_length:
-                        shortest_length = current_length
-                        shortest_link = current_link
-                interlink = shortest_link
-            elif len(interlink) == 1:
-                interlink = interlink.pop()
+                interlink = interlink[0]
             else:
                 raise TypeError("Check the link relationship between {} and {} and the path is {}".format(prevnd,
                                                                                                           currentnd,
@@ -705,7 +951,7 @@ class GraphBuilder:
             elif len(interlink_pts) > 2:
                 #   need add in intermediate pts
                 #   check the sequence of intermediate pts
-                if interlink_pts[0].distance(self.node_storage[prevnd]) > 1:
+                if not self.link_starts_at(interlink, prevnd):
                     interlink_pts.reverse()
                 for idx, nd in enumerate(interlink_pts):
                     if idx == 0:
@@ -855,9 +1101,9 @@ class GraphBuilder:
                     #   if there are more than 1 self.links between two self.node
                     #   choose either of them as distance since they are likely to be similar
                     if prev_nd is None:
-                        record[top][i]["total_length"] = self.link_storage[dist].length
+                        record[top][i]["total_length"] = self.link_attr.length[dist]
                     else:
-                        record[top][i]["total_length"] = record[prev_nd][top]["total_length"] + self.link_storage[dist].length
+                        record[top][i]["total_length"] = record[prev_nd][top]["total_length"] + self.link_attr.length[dist]
                     break
             if current_nd == stack[-1] and len(stack) > 2:
                 #   when current_nd is founded
@@ -896,6 +1142,21 @@ class GraphBuilder:
                 cycle_res.append((cycle, dist))
         return cycle_res
 
+    def link_ends_near(self, l_idx, pt):
+        '''
+        check_endpt of pt and link l_idx, read from link_attr.ends
+        '''
+        start, end = self.link_attr.ends[l_idx]
+        xy = (pt.x, pt.y)
+        return pt_gap(start, xy, self.grid_size) < 1 or pt_gap(end, xy, self.grid_size) < 1
+
+    def link_starts_at(self, l_idx, n_idx):
+        '''
+        :return: True if the first vertex of link l_idx (from link_attr.ends) lies within 1 of node n_idx
+        '''
+        pt = self.node_storage[n_idx]
+        return pt_gap(self.link_attr.ends[l_idx, 0], (pt.x, pt.y), self.grid_size) <= 1
+
     def find_whole_cycle_geom(self, cycle):
         cycle = cycle.copy()
         whole_path_node = list()
@@ -905,20 +1166,10 @@ class GraphBuilder:
                 #   从第二位置遍历开始
                 whole_path_node.append(self.node_storage[prevnd])
                 continue
-            interlink: set = self.node[prevnd].intersection(self.node[currentnd])
-            if len(interlink) > 1:
+            interlink: list = self.links_between(prevnd, currentnd)
+            if interlink:
                 #   return the shortest link at this junction
-                shortest_link = interlink.pop()
-                shortest_length = self.link_storage[shortest_link].length
-                while interlink:
-                    current_link = interlink.pop()
-                    current_length = self.link_storage[current_link].length
-                    if current_length < shortest_length:
-                        shortest_length = current_length
-                        shortest_link = current_link
-                interlink = shortest_link
-            elif len(interlink) == 1:
-                interlink = interlink.pop()
+                interlink = interlink[0]
             else:
                 raise TypeError("Check the link relationship between {} and {}".format(prevnd, currentnd))
 
@@ -928,7 +1179,7 @@ class GraphBuilder:
             elif len(interlink_pts) > 2:
                 #   add intermediate pts
                 #   ensuring the sequence of intermediate pts
-                if interlink_pts[0].distance(self.node_storage[prevnd]) > 1:
+                if not self.link_starts_at(interlink, prevnd):
                     interlink_pts.reverse()
                 for idx, nd in enumerate(interlink_pts):
                     if idx == 0:
@@ -1045,24 +1296,14 @@ class GraphBuilder:
         #         2 return the shorter one
         if record is None:
             record = set()
-        inter_link_sets = self.node[nd1].intersection(self.node[nd2])
+        inter_link_sets = self.links_between(nd1, nd2)
         if len(inter_link_sets) > 1:
             #   one cycle contains only two nds
             if mode == "shortest":
                 '''
                 shortest mode: return the minimal length link
                 '''
-                shortest_link = None
-                shortest_len = None
-                for li in inter_link_sets:
-                    if li not in record:
-                        if shortest_link is None:
-                            #   initialization
-                            shortest_link = li
-                            shortest_len = self.link_storage[li].length
-                        elif self.link_storage[li].length < shortest_len:
-                            shortest_link = li
-                            shortest_len = self.link_storage[li].length
+                shortest_link = self.shortest_link_between(nd1, nd2, record)
                 if shortest_link is not None:
                     record.add(shortest_link)
                     return shortest_link, record
@@ -1082,10 +1323,11 @@ class GraphBuilder:
 
     def cycle_simplify(self, min_cycle, node_graph, link_graph, node_manage):
         '''
-        Aggregate the minimal cycles into a distinct segment
+        Aggregate the minimal cycles into a distinct segment.
+        node_graph and link_graph are updated in place and returned
         '''
-        sub_n = deepcopy(node_graph)
-        sub_l = deepcopy(link_graph)
+        sub_n = node_graph
+        sub_l = link_graph
         #   Find the turning pts
         manage = dict()
         endnd = list()  # record searched elements
@@ -1159,7 +1401,7 @@ class GraphBuilder:
             current_step = 0
             next_step = 1
             while next_step < len(min_cycle):
-                link_list = self.node[min_cycle[current_step]].intersection(self.node[min_cycle[next_step]])
+                link_list = self.links_between(min_cycle[current_step], min_cycle[next_step])
                 for li_idx in link_list:
                     #   delete the connections
                     _, sub_n, sub_l = self.del_links(li_idx, [sub_n, sub_l])
@@ -1184,7 +1426,7 @@ class GraphBuilder:
                             subgraph[1]: link -> node
         :return:
         '''
-        duplication_links = list(self.node[nd1].intersection(self.node[nd2]))
+        duplication_links = self.links_between(nd1, nd2)
         if len(duplication_links) < 2:
             raise Exception("No duplication founded")
         times = len(duplication_links)
@@ -1497,9 +1739,13 @@ class GraphBuilder:
         if endli is None:
             endli = set()
         if lid.__class__ == int:
+            if self.topology is not None:
+                return self.topology.link_neighbours([lid], endli)
             li_list = list(self.link[lid])
             endli.add(lid)
         elif lid.__class__ == list:
+            if self.topology is not None:
+                return self.topology.link_neighbours(lid, endli)
             li_list = set()
             for i in lid:
                 li_list = li_list.union(self.link[i])
@@ -1525,9 +1771,9 @@ class GraphBuilder:
         for currentnd in seq:
             if currentnd == prevnd:
                 continue
-            linkseq = linkseq.union(self.node[prevnd].intersection(self.node[currentnd]))
+            linkseq.update(self.links_between(prevnd, currentnd))
             prevnd = currentnd
-        return set(linkseq)
+        return linkseq
 
     def Node_forward_Node(self, nid, node_graph, link_graph, endpt=None, endlk=None):
         if endpt is None:
@@ -1535,6 +1781,11 @@ class GraphBuilder:
 
         if endlk is None:
             endlk = set()
+        if self.topology is not None and node_graph is self.node and link_graph is self.link:
+            if nid.__class__ == int:
+                return self.topology.node_neighbours([nid], endpt, endlk)
+            elif nid.__class__ == list:
+                return self.topology.node_neighbours(nid, endpt, endlk)
         if nid.__class__ == int:
             li_list = list(node_graph[nid])
             endpt.add(nid)
@@ -1556,6 +1807,25 @@ class GraphBuilder:
 
         return res_node, endpt, endlk
 
+    def links_between(self, nd1, nd2):
+        '''
+        :return: new list of the links joining nd1 and nd2, shortest first and by id among equal lengths. Read
+                 from link_pairs while it is kept, else from the intersection of the two node sets
+        '''
+        if self.link_pairs is not None and nd1 != nd2:
+            return self.link_pairs.links(nd1, nd2)
+        length = self.link_attr.length
+        return sorted(self.node[nd1].intersection(self.node[nd2]), key=lambda l: (length[l], l))
+
+    def shortest_link_between(self, nd1, nd2, record=()):
+        '''
+        :return: the first link of links_between(nd1, nd2) that is not in record, None if there is none
+        '''
+        for li in self.links_between(nd1, nd2):
+            if li not in record:
+                return li
+        return None
+
     def Link_between_Nodes(self, nd1, nd2, record=None, mode='shortest'):
         """
         This method returns the link between two nodes, but there are two cases:,
@@ -1573,24 +1843,14 @@ class GraphBuilder:
         """
         if record is None:
             record = set()
-        inter_link_sets = self.node[nd1].intersection(self.node[nd2])
+        inter_link_sets = self.links_between(nd1, nd2)
         if len(inter_link_sets) > 1:
             #   one cycle contains only two nds
             if mode == "shortest":
                 '''
                 shortest mode: return the minimal length link
                 '''
-                shortest_link = None
-                shortest_len = None
-                for li in inter_link_sets:
-                    if li not in record:
-                        if shortest_link is None:
-                            #   initialization
-                            shortest_link = li
-                            shortest_len = self.link_storage[li].length
-                        if self.link_storage[li].length < shortest_len:
-                            shortest_link = li
-                            shortest_len = self.link_storage[li].length
+                shortest_link = self.shortest_link_between(nd1, nd2, record)
                 if shortest_link is not None:
                     record.add(shortest_link)
                     return shortest_link, record
@@ -1640,10 +1900,12 @@ class GraphBuilder:
             raise ValueError("{} self.node is none".format(nid))
         #   update the nid geometry first
         #   then update the links connected to this node
+        new_xy = (new_geom.x, new_geom.y)
         for li in self.node[nid]:
             pt_list = Points_in_Line(self.link_storage[li])
+            start, end = self.link_attr.ends[li]
             #   Detect whether the newly added point is the head or the tail
-            if pt_list[0].distance(new_geom) < pt_list[-1].distance(new_geom):
+            if pt_gap(start, new_xy, self.grid_size) < pt_gap(end, new_xy, self.grid_size):
                 #   at head
                 pt_list[0] = new_geom
             else:
@@ -1653,7 +1915,11 @@ class GraphBuilder:
             if len(pt_list) > 3:
                 pt_list = straighten_links(pt_list)
             self.link_storage[li] = LineString(pt_list)
+            if self.link_pairs is not None:
+                self.link_pairs.refresh(li, self.link[li])
         self.node_storage[nid] = new_geom
+        self.node_registry.insert(nid, new_geom.x, new_geom.y)
+        self.journal.record('node_geom', nid)
 
     def update_replacing_node(self, target_nid, replaced_set, sub_graph=None):
         if replaced_set.__class__ is list:
@@ -1663,13 +1929,21 @@ class GraphBuilder:
             if replaced_id not in self.node:
                 #   was updated before
                 continue
-            link_set = self.node[replaced_id]
-            for li_idx in link_set:
-                self.link[li_idx].remove(replaced_id)
-                self.link[li_idx].add(target_nid)
-                self.node[target_nid].add(li_idx)
-            self.node.pop(replaced_id)
-            self.node_storage[replaced_id] = None
+            moved = list(self.node[replaced_id]) if self.link_pairs is not None else ()
+            for li_idx in moved:
+                self.link_pairs.remove_link(li_idx, self.link[li_idx])
+            if self.topology is not None:
+                self.topology.replace_node(target_nid, replaced_id)
+            else:
+                link_set = self.node[replaced_id]
+                for li_idx in link_set:
+                    self.remove_node_from_link(li_idx, replaced_id)
+                    self.add_node_to_link(li_idx, target_nid)
+                    self.add_link_to_node(target_nid, li_idx)
+                self.node.pop(replaced_id)
+            for li_idx in moved:
+                self.link_pairs.add_link(li_idx, self.link[li_idx])
+            self.del_node_geom(replaced_id)
         if sub_graph is not None:
             node_graph = sub_graph[0]
             link_graph = sub_graph[1]
@@ -1698,13 +1972,18 @@ class GraphBuilder:
             real_idx = len(self.link_storage)
             newid.append(real_idx)
             self.link_storage.append(link_geometry)
-            #   update connectivity of link
-            self.link[real_idx] = mapping_relations[tem_idx]
             node_set = mapping_relations[tem_idx]
-            #   update connectivity of node
-            for i in node_set:
-                if real_idx not in self.node[i]:
-                    self.node[i].add(real_idx)
+            if self.topology is not None:
+                self.topology.add_link(real_idx, node_set)
+            else:
+                #   update connectivity of link
+                self.link[real_idx] = node_set
+                #   update connectivity of node
+                for i in node_set:
+                    if real_idx not in self.node[i]:
+                        self.add_link_to_node(i, real_idx)
+            if self.link_pairs is not None:
+                self.link_pairs.add_link(real_idx, node_set)
             if sub_graph is not None:
                 #   update connectivity of subgraph
                 sub_node = sub_graph[0]
@@ -1735,12 +2014,16 @@ class GraphBuilder:
             raise TypeError("plz check the the type of 'l_id_list'")
         del_relationships = dict()  # 保留被删除的links相关关系
         for li_id in l_id_list:
-            node_set = self.link[li_id]
-            del_relationships[li_id] = node_set
-            if li_id in self.link:
-                self.link.pop(li_id)
-            for n_id in node_set:
-                self.node[n_id].discard(li_id)
+            if self.topology is not None:
+                node_set = self.topology.remove_link(li_id)
+                del_relationships[li_id] = node_set
+            else:
+                node_set = self.link[li_id]
+                del_relationships[li_id] = node_set
+                if li_id in self.link:
+                    self.link.pop(li_id)
+                for n_id in node_set:
+                    self.remove_link_from_node(n_id, li_id)
             if sub_graph is not None:
                 sub_node = sub_graph[0]
                 sub_link = sub_graph[1]
@@ -1750,6 +2033,8 @@ class GraphBuilder:
                     if n_id in sub_node:
                         sub_node[n_id].discard(li_id)
             self.link_storage[li_id] = None
+            if self.link_pairs is not None:
+                self.link_pairs.remove_link(li_id, node_set)
         if sub_graph is None:
             return del_relationships
         else:
@@ -1758,48 +2043,72 @@ class GraphBuilder:
 
 #%%
     def check_graph_validation(self):
-        status_n = self.check_node_validation()
-        status_l = self.check_link_validation()
-        if status_l and status_n:
-            # both link and node are all valid
-            return
-        else:
-            self.check_graph_validation()
+        status_n = status_l = 0
+        while not (status_l and status_n):
+            # repeat until both link and node are all valid
+            status_n = self.check_node_validation()
+            status_l = self.check_link_validation()
+
+    def scan_dirty(self, dirty, sub):
+        '''
+        Yield the ids of the dirty set and of the unread events of the journal subscription sub in increasing
+        order, as the full id scan of a check would meet them. Ids written while the scan runs are yielded in
+        the same scan when they are ahead of it and are left in dirty for the next scan otherwise, exactly the
+        ones a full scan would have revisited. Ids not written since their last check are valid, so skipping
+        them gives the result of the full scan
+        '''
+        dirty.update(e.id for e in self.journal.poll(sub))
+        pending = list(dirty)
+        dirty.clear()
+        heapq.heapify(pending)
+        last = -1
+        while pending:
+            idx = heapq.heappop(pending)
+            if idx <= last:
+                continue
+            last = idx
+            yield idx
+            for e in self.journal.poll(sub):
+                if e.id > last:
+                    heapq.heappush(pending, e.id)
+                elif e.id != idx:
+                    # the check of idx deleted it or left it unchanged, its own writes need no revisit
+                    dirty.add(e.id)
 
     def check_link_validation(self, status=1):
-        for l_id in range(len(self.link_storage)):
-            if self.link_storage[l_id] is None:
+        for l_id in self.scan_dirty(self.dirty_links, self.subs['link_checks']):
+            if l_id >= len(self.link_storage) or np.isnan(self.link_attr.length[l_id]):
                 continue
             if len(self.link[l_id]) == 0:
                 self.link_storage[l_id] = None
                 self.link.pop(l_id)
                 status = 0  # there has invalid connectivity in this check
                 continue
-            if self.link_storage[l_id].length == 0:
+            if self.link_attr.length[l_id] == 0:
                 status = 0  # means there has invalid links in this check
                 self.link_storage[l_id] = None
-                keep_nid = self.link[l_id].pop()
+                keep_nid = self.pop_node_from_link(l_id)
                 for n_id in self.link[l_id]:
                     self.node[keep_nid] = self.node[keep_nid].union(self.node[n_id])
                     for l in self.node[n_id]:
-                        self.link[l].discard(n_id)
-                        self.link[l].add(keep_nid)
+                        self.remove_node_from_link(l, n_id)
+                        self.add_node_to_link(l, keep_nid)
                     if n_id in self.node:
                         self.node.pop(n_id)
-                        self.node_storage[n_id] = None
-                self.node[keep_nid].discard(l_id)
+                        self.del_node_geom(n_id)
+                self.remove_link_from_node(keep_nid, l_id)
                 if l_id in self.link:
                     self.link.pop(l_id)
         return status
 
     def check_node_validation(self, status=1):
-        for n_idx, stg in enumerate(self.node_storage):
-            if stg is None:
+        for n_idx in self.scan_dirty(self.dirty_nodes, self.subs['node_checks']):
+            if n_idx >= len(self.node_storage) or self.node_storage[n_idx] is None:
                 continue
             if len(self.node[n_idx]) < 2:
                 for i in self.node[n_idx]:
-                    self.link[i].discard(n_idx)
-                self.node_storage[n_idx] = None
+                    self.remove_node_from_link(i, n_idx)
+                self.del_node_geom(n_idx)
                 self.node.pop(n_idx)
                 status = 0  # means nodes are all valid
         return status
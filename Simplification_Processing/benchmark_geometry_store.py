@@ -0,0 +1,79 @@
+import sys
+import time
+import ctypes
+import warnings
+import numpy as np
+import geopandas as gpd
+import shapely
+from geometry_store import LinkGeometryStore, NodeGeometryStore, LinkAttributeTable
+from benchmark_noding import tiled, timed
+warnings.simplefilter("ignore")
+
+
+class _MallInfo2(ctypes.Structure):
+    _fields_ = [(name, ctypes.c_size_t) for name in ('arena', 'ordblks', 'smblks', 'hblks', 'hblkhd', 'usmblks',
+                                                     'fsmblks', 'uordblks', 'fordblks', 'keepcost')]
+
+
+def heap_counter():
+    '''
+    :return: callable giving the bytes allocated by malloc (GEOS geometries included), None without glibc
+    '''
+    try:
+        mallinfo2 = ctypes.CDLL("libc.so.6").mallinfo2
+    except (OSError, AttributeError):
+        return None
+    mallinfo2.restype = _MallInfo2
+
+    def used():
+        info = mallinfo2()
+        return info.uordblks + info.hblkhd
+    return used
+
+
+def shapely_bytes(build, used):
+    '''
+    bytes taken by the list of shapely objects build() returns: the GEOS heap it allocates plus the Python
+    wrappers
+    '''
+    before = used()
+    geoms = build()
+    heap = used() - before
+    return heap + sum(sys.getsizeof(g) for g in geoms) + sys.getsizeof(geoms), geoms
+
+
+if __name__ == '__main__':
+    fileaddress = "./TestFile/TestFile.shp"
+    data = gpd.read_file(fileaddress).to_crs('epsg:3857')
+    geoms = tiled(data[data['geometry'].notna()].explode().geometry.to_list(), 8)
+    coords, owner = shapely.get_coordinates(geoms, return_index=True)
+    parts = np.split(coords, np.cumsum(np.bincount(owner))[:-1])
+    del geoms
+    used = heap_counter()
+    if used is None:
+        sys.exit("the memory counts need glibc (mallinfo2)")
+
+    list_bytes, lines = shapely_bytes(lambda: [shapely.linestrings(p) for p in parts], used)
+    store = LinkGeometryStore.from_geoms(lines)
+    print("links: {}  vertices: {} ({:.1f} per link)".format(len(lines), len(coords), len(coords) / len(lines)))
+    print("list of LineStrings: {:8.1f} bytes per link".format(list_bytes / len(lines)))
+    print("LinkGeometryStore:   {:8.1f} bytes per link ({:.1f}x less)".format(
+        store.nbytes / len(lines), list_bytes / store.nbytes))
+    print("  both keep the link attribute table: {:.1f} bytes per link".format(
+        (store.attrs.length.nbytes + store.attrs.ends.nbytes) / len(lines)))
+
+    pts = coords[np.unique(coords, axis=0, return_index=True)[1]]
+    point_bytes, points = shapely_bytes(lambda: list(shapely.points(pts)), used)
+    nodes = NodeGeometryStore.from_geoms(points)
+    print("\nnodes: {}".format(len(points)))
+    print("list of Points:      {:8.1f} bytes per node".format(point_bytes / len(points)))
+    print("NodeGeometryStore:   {:8.1f} bytes per node ({:.1f}x less)".format(
+        nodes.nbytes / len(points), point_bytes / nodes.nbytes))
+
+    print("\nlength and end coordinates of every link")
+    geos_time, _ = timed(LinkAttributeTable.from_geoms, lines, 3)
+    build_time, _ = timed(lambda s: LinkAttributeTable.from_geoms(list(s)), store, 3)
+    bulk_time, _ = timed(lambda s: (s.lengths(), s.endpoints()), store, 3)
+    print("from the LineStrings:             {:.4f} s".format(geos_time))
+    print("building the LineStrings first:   {:.4f} s".format(build_time))
+    print("from the buffer:                  {:.4f} s".format(bulk_time))
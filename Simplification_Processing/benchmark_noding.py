@@ -0,0 +1,90 @@
+import time
+import warnings
+import numpy as np
+import geopandas as gpd
+import shapely
+from noding import split_points
+warnings.simplefilter("ignore")
+
+
+def pair_loop_split_points(geoms):
+    '''
+    the former main.py noding: every pair of lines is tested in a Python double loop
+    '''
+    pts_list = [[] for _ in geoms]
+    for o in range(len(geoms)):
+        for d in range(o + 1, len(geoms)):
+            line1 = geoms[o]
+            line2 = geoms[d]
+            if line1.intersects(line2):
+                intersectionPT = line1.intersection(line2)
+                if intersectionPT.geom_type == 'MultiPoint':
+                    for i in intersectionPT.geoms:
+                        pts_list[o].append((i.x, i.y))
+                        pts_list[d].append((i.x, i.y))
+                elif intersectionPT.geom_type == 'Point':
+                    pts_list[o].append((intersectionPT.x, intersectionPT.y))
+                    pts_list[d].append((intersectionPT.x, intersectionPT.y))
+    return [np.array(i, dtype=float).reshape(-1, 2) for i in pts_list]
+
+
+def timed(fn, geoms, repeat):
+    best = None
+    res = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        res = fn(geoms)
+        cost = time.perf_counter() - start
+        best = cost if best is None else min(best, cost)
+    return best, res
+
+
+def same_split_points(res1, res2):
+    return len(res1) == len(res2) and all(np.array_equal(a, b) for a, b in zip(res1, res2))
+
+
+def same_point_sets(res1, res2, tolerance=1e-6):
+    '''
+    the backends order the points of a line differently and proper crossings can differ in the last digits
+    '''
+    if len(res1) != len(res2):
+        return False
+    for a, b in zip(res1, res2):
+        a, b = np.unique(a, axis=0), np.unique(b, axis=0)
+        if len(a) != len(b) or (len(a) and np.abs(a - b).max() > tolerance):
+            return False
+    return True
+
+
+def tiled(geoms, k):
+    '''
+    k x k translated copies of the network, side by side, to scale the input size
+    '''
+    xmin, ymin, xmax, ymax = shapely.total_bounds(geoms)
+    width, height = xmax - xmin, ymax - ymin
+    return [shapely.transform(g, lambda xy, dx=dx, dy=dy: xy + (dx, dy)) for dx in np.arange(k) * width
+            for dy in np.arange(k) * height for g in geoms]
+
+
+if __name__ == '__main__':
+    fileaddress = "./TestFile/TestFile.shp"
+    data = gpd.read_file(fileaddress).to_crs('epsg:3857')
+    data = data[data['geometry'].notna()].explode()
+    geoms = data.geometry.to_list()
+
+    loop_time, loop_res = timed(pair_loop_split_points, geoms, 1)
+    vec_time, vec_res = timed(split_points, geoms, 5)
+    print("lines: {}  split points: {}".format(len(geoms), sum(len(i) for i in vec_res)))
+    print("pair loop:  {:.4f} s".format(loop_time))
+    print("noding:     {:.4f} s  ({:.1f}x)".format(vec_time, loop_time / vec_time))
+    print("identical output: {}".format(same_split_points(loop_res, vec_res)))
+
+    print("\nintersection backends by input size")
+    print("{:>8} {:>10} {:>12} {:>10} {:>8}  {}".format("lines", "points", "strtree (s)", "sweep (s)", "ratio", "same"))
+    for k in (1, 2, 4, 8):
+        scaled = tiled(geoms, k)
+        tree_time, tree_res = timed(split_points, scaled, 3)
+        sweep_time, sweep_res = timed(lambda g: split_points(g, method='sweep'), scaled, 3)
+        print("{:>8} {:>10} {:>12.4f} {:>10.4f} {:>7.1f}x  {}".format(
+            len(scaled), sum(len(i) for i in tree_res), tree_time, sweep_time, tree_time / sweep_time,
+            same_point_sets(tree_res, sweep_res)))
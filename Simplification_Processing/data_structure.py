@@ -1,3 +1,10 @@
+from math import floor, sqrt
+import heapq
+from collections import namedtuple, deque
+from collections.abc import MutableMapping, MutableSet
+import numpy as np
+
+
 class Queue:
     def __init__(self, ):
         self._data = []
@@ -101,3 +108,931 @@ class LinkedList:
             current = current.next
         return node_values
 
+
+class NodeRegistry:
+    '''
+    Grid hash over node coordinates (EPSG:3857) used to snap new points onto existing nodes.
+    The cell size equals the snapping tolerance, so a lookup only visits the 3x3 cells around the point.
+    '''
+    def __init__(self, tolerance=1):
+        self.tolerance = tolerance
+        self._cells = dict()    # (cx, cy) -> set of node ids
+        self._coords = dict()   # node id -> (x, y)
+
+    def __len__(self):
+        return len(self._coords)
+
+    def __contains__(self, idx):
+        return idx in self._coords
+
+    def _cell(self, x, y):
+        return floor(x / self.tolerance), floor(y / self.tolerance)
+
+    def insert(self, idx, x, y):
+        if idx in self._coords:
+            self.remove(idx)
+        self._coords[idx] = (x, y)
+        self._cells.setdefault(self._cell(x, y), set()).add(idx)
+
+    def remove(self, idx):
+        if idx not in self._coords:
+            return
+        x, y = self._coords.pop(idx)
+        cell = self._cell(x, y)
+        self._cells[cell].discard(idx)
+        if len(self._cells[cell]) == 0:
+            self._cells.pop(cell)
+
+    def find(self, x, y):
+        '''
+        :return: the smallest node id closer than tolerance to (x, y), None if there is no such node.
+                 The smallest id is what a linear scan over node_storage would have returned first.
+        '''
+        cx, cy = self._cell(x, y)
+        found = None
+        for i in (cx - 1, cx, cx + 1):
+            for j in (cy - 1, cy, cy + 1):
+                for idx in self._cells.get((i, j), ()):
+                    if found is not None and idx > found:
+                        continue
+                    nx, ny = self._coords[idx]
+                    if sqrt((nx - x) * (nx - x) + (ny - y) * (ny - y)) < self.tolerance:
+                        found = idx
+        return found
+
+
+class TrackedDict(dict):
+    '''
+    dict reporting to on_change(key) every key it assigns or removes. Reads report nothing, and neither do
+    in-place changes of a value (d[k].add(x)): the code making them reports them with touch(key)
+    '''
+    def __init__(self, data=(), on_change=None):
+        super().__init__(data)
+        self.on_change = on_change
+
+    def __reduce__(self):
+        return dict, (dict(self),)
+
+    def __setitem__(self, key, value):
+        self.on_change(key)
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self.on_change(key)
+        super().__delitem__(key)
+
+    def pop(self, key, *default):
+        if key in self:
+            self.on_change(key)
+        return super().pop(key, *default)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self.on_change(key)
+        return super().setdefault(key, default)
+
+    def touch(self, key):
+        '''
+        report an in-place change of the value of key
+        '''
+        self.on_change(key)
+
+    def update(self, data=(), **kwargs):
+        items = data.items() if hasattr(data, 'items') else data
+        for key, value in items:
+            self[key] = value
+        for key, value in kwargs.items():
+            self[key] = value
+
+
+class LinkPairIndex:
+    '''
+    Unordered node pair -> ids of the links joining the two nodes, sorted by length and then by id, so the
+    first one is the shortest link of the pair. attrs is the LinkAttributeTable the lengths are read from;
+    refresh a link after its geometry changed
+    '''
+    def __init__(self, attrs):
+        self.attrs = attrs
+        self.pairs = dict()     # (n1, n2), n1 < n2 -> list of links, shortest first
+
+    @classmethod
+    def from_links(cls, link, attrs):
+        '''
+        :param link: link -> nodes connectivity
+        '''
+        index = cls(attrs)
+        for l, nodes in link.items():
+            if nodes:
+                index.add_link(l, nodes)
+        return index
+
+    @staticmethod
+    def _keys(nodes):
+        nodes = sorted(nodes)
+        return [(a, b) for k, a in enumerate(nodes) for b in nodes[k + 1:]]
+
+    def _sort(self, links):
+        length = self.attrs.length
+        links.sort(key=lambda l: (length[l], l))
+
+    def add_link(self, l, nodes):
+        for key in self._keys(nodes):
+            links = self.pairs.setdefault(key, list())
+            if l not in links:
+                links.append(l)
+                self._sort(links)
+
+    def remove_link(self, l, nodes):
+        for key in self._keys(nodes):
+            links = self.pairs.get(key)
+            if links is None or l not in links:
+                continue
+            links.remove(l)
+            if not links:
+                del self.pairs[key]
+
+    def refresh(self, l, nodes):
+        for key in self._keys(nodes):
+            if key in self.pairs:
+                self._sort(self.pairs[key])
+
+    def links(self, n1, n2):
+        '''
+        :return: new list of the links joining n1 and n2, shortest first and by id among equal lengths
+        '''
+        return list(self.pairs.get((n1, n2) if n1 < n2 else (n2, n1), ()))
+
+
+class LinkChain:
+    '''
+    Links joined end to end (run_Combine_PassLinks), kept as the deque of their coordinate arrays so the
+    joined LineString is built once by coords(). A piece is (coords, reversed); flip reverses the whole
+    chain without touching the pieces. A join moves the pieces of the shorter chain into the longer one
+    '''
+    def __init__(self, coords):
+        self.pieces = deque([(coords, False)])
+        self.flip = False
+        self.start, self.end = tuple(coords[0].tolist()), tuple(coords[-1].tolist())
+
+    def reverse(self):
+        self.flip = not self.flip
+        self.start, self.end = self.end, self.start
+
+    def _ordered(self):
+        '''
+        :return: the pieces from start to end
+        '''
+        if not self.flip:
+            return iter(self.pieces)
+        return ((c, not r) for c, r in reversed(self.pieces))
+
+    @staticmethod
+    def join(first, second):
+        '''
+        :return: the chain of first followed by second, one of the two reused
+        '''
+        if len(first.pieces) >= len(second.pieces):
+            for c, r in second._ordered():
+                if first.flip:
+                    first.pieces.appendleft((c, not r))
+                else:
+                    first.pieces.append((c, r))
+            first.end = second.end
+            return first
+        for c, r in reversed(list(first._ordered())):
+            if second.flip:
+                second.pieces.append((c, not r))
+            else:
+                second.pieces.appendleft((c, r))
+        second.start = first.start
+        return second
+
+    def coords(self):
+        return np.concatenate([c[::-1] if r else c for c, r in self._ordered()])
+
+
+class NeighbourhoodStats:
+    '''
+    Cached 2-hop neighbourhoods of links and the length statistics over them (run_remove_anomalous_shortlinks).
+    An entry is registered under the links and nodes read to find the neighbourhood and under the links of
+    the neighbourhood (for their lengths); invalidate() drops it when a journal event names one of them.
+    attrs is the LinkAttributeTable the lengths are read from
+    '''
+    def __init__(self, attrs):
+        self.attrs = attrs
+        self.entries = dict()       # link -> (mean length, 33rd percentile length), None without neighbours
+        self.link_users = dict()    # link -> links whose entry depends on it
+        self.node_users = dict()    # node -> links whose entry depends on it
+
+    def get(self, l, neighbourhood):
+        '''
+        :param neighbourhood: callable(l) -> (links of the neighbourhood, links read, nodes read), called
+                              when l has no valid entry
+        :return: mean and 33rd percentile of the neighbourhood lengths, None if it is empty
+        '''
+        if l in self.entries:
+            return self.entries[l]
+        related, links, nodes = neighbourhood(l)
+        related = set(related)
+        stats = None
+        if related:
+            lengths = np.sort(self.attrs.length[list(related)])
+            stats = float(lengths.mean()), float(np.percentile(lengths, 33))
+        self.entries[l] = stats
+        for r in related.union(links):
+            self.link_users.setdefault(r, set()).add(l)
+        for n in nodes:
+            self.node_users.setdefault(n, set()).add(l)
+        return stats
+
+    def invalidate(self, events):
+        '''
+        :param events: JournalEvents of kinds link, node and link_geom
+        '''
+        for e in events:
+            users = self.node_users if e.kind == 'node' else self.link_users
+            for user in users.pop(e.id, ()):
+                self.entries.pop(user, None)
+
+
+class ShortestPathSearch:
+    '''
+    Dijkstra over the node/link graph with a hop limit. Distance, hops, predecessor and origin of every
+    node live in lists indexed by node id, stamped with the number of the search that wrote them: a new
+    search starts without clearing anything and the lists are reused (they only grow with the node ids).
+    A search may start from several sources at once; every node then records the source whose region it
+    joined (origin) and meetings lists the links (u, v, link) found joining two regions
+    '''
+    def __init__(self, size=0):
+        self.dist = [0.0] * size
+        self.hops = [0] * size
+        self.prev = [-1] * size     # predecessor node, -1 for a source
+        self.origin = [-1] * size
+        self.seen = [0] * size      # number of the search that gave the node a distance
+        self.done = [0] * size      # number of the search that settled the node
+        self.search = 0
+        self.meetings = list()
+
+    def _ensure(self, size):
+        if size <= len(self.dist):
+            return
+        extra = max(size, 2 * len(self.dist)) - len(self.dist)
+        self.dist += [0.0] * extra
+        self.hops += [0] * extra
+        self.prev += [-1] * extra
+        self.origin += [-1] * extra
+        self.seen += [0] * extra
+        self.done += [0] * extra
+
+    def run(self, sources, node, link, length, size, hop_limit=None, targets=(), blocked=(), first_blocked=()):
+        '''
+        :param sources: node ids the search starts from, at distance 0
+        :param node, link: node -> links and link -> nodes connectivity
+        :param length: link id -> link length
+        :param size: upper bound of the node ids
+        :param hop_limit: nodes reached through hop_limit links are not expanded
+        :param targets: nodes recorded when settled and not expanded (sources excepted)
+        :param blocked: nodes never entered
+        :param first_blocked: nodes not entered straight from a source
+        :return: list of the targets reached, nearest first. meetings is left sorted by the length of the
+                 path the link closes between the two sources, then by (u, v, link) with u < v
+        '''
+        self._ensure(size)
+        self.search += 1
+        search = self.search
+        dist, hops, prev, origin, seen, done = self.dist, self.hops, self.prev, self.origin, self.seen, self.done
+        meetings = list()
+        heap = list()
+        for k, s in enumerate(sources):
+            seen[s] = search
+            dist[s], hops[s], prev[s], origin[s] = 0.0, 0, -1, s
+            heap.append((0.0, k, s))
+        heapq.heapify(heap)
+        order = len(heap)
+        reached = list()
+        while heap:
+            d, _, cur = heapq.heappop(heap)
+            if done[cur] == search or d > dist[cur]:
+                continue
+            done[cur] = search
+            if hops[cur] and cur in targets:
+                reached.append(cur)
+                continue
+            if hop_limit is not None and hops[cur] >= hop_limit:
+                continue
+            for li in node[cur]:
+                w = d + float(length[li])
+                for nxt in link[li]:
+                    if nxt == cur or nxt in blocked or (hops[cur] == 0 and nxt in first_blocked):
+                        continue
+                    if seen[nxt] == search:
+                        if origin[nxt] != origin[cur]:
+                            meetings.append((cur, nxt, li))
+                        if done[nxt] == search or w >= dist[nxt]:
+                            continue
+                    seen[nxt] = search
+                    dist[nxt], hops[nxt], prev[nxt], origin[nxt] = w, hops[cur] + 1, cur, origin[cur]
+                    heapq.heappush(heap, (w, order, nxt))
+                    order += 1
+        #   origins may change after a meeting was seen: keep the links still joining two regions
+        meetings = {(min(u, v), max(u, v), li) for u, v, li in meetings if origin[u] != origin[v]}
+        self.meetings = sorted(meetings, key=lambda m: (dist[m[0]] + float(length[m[2]]) + dist[m[1]], m))
+        return reached
+
+    def path(self, nid):
+        '''
+        :return: node ids from nid back to the source it was reached from, for a node of the last search
+        '''
+        res = list()
+        while nid != -1:
+            res.append(nid)
+            nid = self.prev[nid]
+        return res
+
+
+class MergeGroups:
+    '''
+    Merging groups built by run_IdentifyParrallelCrossing and grown by run_find_close_cycles_on_graph.
+    The former merging_dict (link -> slot) and merging_storage (slot -> set of links) are replaced by disjoint
+    sets over the links (union by size, path compression) mapping every root to its slot, each root keeping
+    the list of its members: a union relinks one root and moves the members of the smaller group instead
+    of copying both sets into a new one. Slots are numbered as merging_storage was (a pair renews the slot
+    of its group), and materialize() builds the merging_dict / merging_storage pair consumed by
+    run_cycle_simplify once, every group set filled in ascending link order. The groups therefore iterate
+    in link order rather than in the order their unions produced, which can change which cycles are
+    simplified first
+    '''
+    def __init__(self):
+        self.parent = dict()
+        self.group = dict()     # root -> list of members
+        self.slot = dict()      # root -> slot
+        self.roots = dict()     # slot -> root
+        self.n_slots = 0
+
+    def __contains__(self, link):
+        return link in self.parent
+
+    def __len__(self):
+        return len(self.roots)
+
+    def find(self, link):
+        root = link
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[link] != root:
+            self.parent[link], link = root, self.parent[link]
+        return root
+
+    def alive(self, slot):
+        return slot in self.roots
+
+    def slot_of(self, link):
+        return self.slot[self.find(link)]
+
+    def members(self, slot):
+        '''
+        :return: new set of the links of the group in slot, filled in ascending order
+        '''
+        return set(sorted(self.group[self.roots[slot]]))
+
+    def _attach(self, root, link):
+        self.parent[link] = root
+        self.group[root].append(link)
+
+    def _union(self, r1, r2):
+        if r1 == r2:
+            return r1
+        for r in (r1, r2):
+            self.roots.pop(self.slot.pop(r, None), None)
+        big, small = (r1, r2) if len(self.group[r1]) >= len(self.group[r2]) else (r2, r1)
+        self.parent[small] = big
+        self.group[big].extend(self.group.pop(small))
+        return big
+
+    def _set_slot(self, root, slot):
+        self.roots.pop(self.slot.get(root), None)
+        self.slot[root] = slot
+        self.roots[slot] = root
+
+    def _new_slot(self, root):
+        self._set_slot(root, self.n_slots)
+        self.n_slots += 1
+
+    def add_pair(self, l1, l2):
+        '''
+        record that links l1 and l2 belong to one group
+        '''
+        if l1 in self.parent and l2 in self.parent:
+            #   even within one group this renews its slot, as the former merging_storage did
+            self._new_slot(self._union(self.find(l1), self.find(l2)))
+        elif l1 in self.parent:
+            self._attach(self.find(l1), l2)
+        elif l2 in self.parent:
+            self._attach(self.find(l2), l1)
+        else:
+            self.parent[l1] = self.parent[l2] = l1
+            self.group[l1] = [l1, l2]
+            self._new_slot(l1)
+
+    def absorb(self, slot, links):
+        '''
+        join links, with the whole groups they belong to, to the group in slot, which keeps its slot
+        '''
+        root = self.roots[slot]
+        for link in links:
+            if link not in self.parent:
+                self._attach(root, link)
+                continue
+            other = self.find(link)
+            if other != root:
+                root = self._union(root, other)
+                self._set_slot(root, slot)
+
+    def materialize(self):
+        '''
+        :return: merging_dict: link -> slot, merging_storage: list slot -> set of links, None for dead slots
+        '''
+        merging_dict = dict()
+        merging_storage = [None] * self.n_slots
+        for slot in sorted(self.roots):
+            members = sorted(self.group[self.roots[slot]])
+            merging_storage[slot] = set(members)
+            merging_dict.update(dict.fromkeys(members, slot))
+        return merging_dict, merging_storage
+
+
+JournalEvent = namedtuple('JournalEvent', ['kind', 'id'])
+
+
+class ChangeJournal:
+    '''
+    Log of the writes to a graph as JournalEvent(kind, id), kind being one of link / node (the links or
+    nodes of the id were written: added, changed or removed) and link_geom / node_geom (its geometry was
+    written). A consumer subscribe()s to some kinds and poll()s the events recorded since its previous
+    poll; events are only kept while a subscriber wanting them has not read them. counts holds the number
+    of events of each kind ever recorded
+    '''
+    KINDS = ('link', 'node', 'link_geom', 'node_geom')
+
+    def __init__(self):
+        self.events = list()
+        self.offset = 0         # number of events dropped from the front of events
+        self.counts = dict.fromkeys(self.KINDS, 0)
+        self.cursors = dict()   # subscription -> [position of its next event, kinds]
+        self.wanted = set()     # kinds received by some subscription
+        self._next_sub = 0
+
+    def record(self, kind, item):
+        self.counts[kind] += 1
+        if kind in self.wanted:
+            self.events.append(JournalEvent(kind, item))
+
+    def subscribe(self, kinds=None):
+        '''
+        :param kinds: kinds of event to receive, None for all
+        :return: subscription id, reading from the next recorded event on
+        '''
+        sub = self._next_sub
+        self._next_sub += 1
+        kinds = frozenset(self.KINDS if kinds is None else kinds)
+        self.cursors[sub] = [self.offset + len(self.events), kinds]
+        self.wanted.update(kinds)
+        return sub
+
+    def unsubscribe(self, sub):
+        self.cursors.pop(sub)
+        self.wanted = set().union(*(c[1] for c in self.cursors.values()))
+        self._trim()
+
+    def poll(self, sub):
+        '''
+        :return: list of the events of subscription sub recorded since its previous poll
+        '''
+        cursor = self.cursors[sub]
+        events = self.events[cursor[0] - self.offset:]
+        cursor[0] = self.offset + len(self.events)
+        self._trim()
+        if len(cursor[1]) < len(self.KINDS):
+            events = [e for e in events if e.kind in cursor[1]]
+        return events
+
+    def _trim(self):
+        first = min((c[0] for c in self.cursors.values()), default=self.offset + len(self.events))
+        if first - self.offset > len(self.events) // 2:
+            del self.events[:first - self.offset]
+            self.offset = first
+
+
+class IncidenceRows:
+    '''
+    Rows of int ids packed in one flat array, CSR style: row r is data[start[r]: start[r] + size[r]].
+    Every row is allocated with some slack, so most additions are written in place; a row that outgrows
+    its slots moves to the end of the array. Removed members are overwritten with a tombstone (-1) and
+    a row is compacted once half of it is tombstones. The holes left behind by moved and deleted rows are
+    reclaimed by rebuild(), which runs by itself when they take more than half of the array.
+    A row is in one of three states: absent, None (key kept without members) or a member row,
+    the states a key of a dict of sets goes through in GraphBuilder.
+    '''
+    TOMBSTONE = -1
+    ABSENT, EMPTY, ROW = 0, 1, 2
+
+    def __init__(self, dtype=np.int32, capacity=1024):
+        self.data = np.full(capacity, self.TOMBSTONE, dtype=dtype)
+        self.start = np.zeros(64, dtype=np.int64)
+        self.size = np.zeros(64, dtype=np.int32)    # used slots, tombstones included
+        self.cap = np.zeros(64, dtype=np.int32)     # allocated slots
+        self.count = np.zeros(64, dtype=np.int32)   # live members
+        self.state = np.zeros(64, dtype=np.int8)
+        self.end = 0        # used length of data
+        self.garbage = 0    # slots of data not owned by any row
+        self.n_keys = 0
+        self.on_change = None   # optional callable(row) called on every change of a row
+
+    def __len__(self):
+        return self.n_keys
+
+    @property
+    def nbytes(self):
+        return sum(i.nbytes for i in (self.data, self.start, self.size, self.cap, self.count, self.state))
+
+    def _ensure_key(self, r):
+        if r < len(self.state):
+            return
+        n = max(2 * len(self.state), r + 1)
+        for name in ('start', 'size', 'cap', 'count', 'state'):
+            old = getattr(self, name)
+            new = np.zeros(n, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def _alloc(self, n):
+        if self.end + n > len(self.data):
+            if self.garbage > self.end // 2:
+                self.rebuild()
+            if self.end + n > len(self.data):
+                new = np.full(max(2 * len(self.data), self.end + n), self.TOMBSTONE, dtype=self.data.dtype)
+                new[:self.end] = self.data[:self.end]
+                self.data = new
+        offset = self.end
+        self.end += n
+        return offset
+
+    @staticmethod
+    def _slack(n):
+        return n + max(2, n // 2)
+
+    def _free(self, r):
+        if self.state[r] == self.ROW:
+            self.garbage += int(self.cap[r])
+        self.start[r] = self.size[r] = self.cap[r] = self.count[r] = 0
+
+    def rebuild(self):
+        '''
+        rewrite all rows contiguously, in key order and without tombstones
+        '''
+        keys = np.nonzero(self.state == self.ROW)[0]
+        rows = [self.members(r) for r in keys.tolist()]
+        caps = np.array([self._slack(len(i)) for i in rows], dtype=np.int64)
+        total = int(caps.sum())
+        self.data = np.full(max(2 * total, 1024), self.TOMBSTONE, dtype=self.data.dtype)
+        offsets = np.cumsum(caps) - caps
+        for r, row, offset in zip(keys.tolist(), rows, offsets.tolist()):
+            self.data[offset: offset + len(row)] = row
+        self.start[keys] = offsets
+        self.size[keys] = self.count[keys] = [len(i) for i in rows]
+        self.cap[keys] = caps
+        self.end = total
+        self.garbage = 0
+
+    def state_of(self, r):
+        return self.state.item(r) if 0 <= r < len(self.state) else self.ABSENT
+
+    def keys(self):
+        return np.nonzero(self.state != self.ABSENT)[0].tolist()
+
+    def _segment(self, r):
+        s = self.start.item(r)
+        return self.data[s: s + self.size.item(r)]
+
+    def members(self, r):
+        s, size = self.start.item(r), self.size.item(r)
+        row = self.data[s: s + size].tolist()
+        if self.count.item(r) != size:
+            row = [v for v in row if v != self.TOMBSTONE]
+        return row
+
+    def set_row(self, r, members):
+        '''
+        :param members: iterable of ids (duplicates are dropped) or None
+        '''
+        self._ensure_key(r)
+        if self.on_change is not None:
+            self.on_change(r)
+        if self.state[r] == self.ABSENT:
+            self.n_keys += 1
+        if members is None:
+            self._free(r)
+            self.state[r] = self.EMPTY
+            return
+        members = list(dict.fromkeys(members))
+        n = len(members)
+        if self.state[r] == self.ROW and self.cap[r] >= n:
+            offset = self.start[r]
+            self.data[offset: offset + self.cap[r]] = self.TOMBSTONE
+        else:
+            cap = self._slack(n)
+            offset = self._alloc(cap)
+            self._free(r)
+            self.start[r], self.cap[r] = offset, cap
+        self.data[offset: offset + n] = members
+        self.size[r] = self.count[r] = n
+        self.state[r] = self.ROW
+
+    def del_row(self, r):
+        if self.state_of(r) == self.ABSENT:
+            raise KeyError(r)
+        self._free(r)
+        self.state[r] = self.ABSENT
+        self.n_keys -= 1
+        if self.on_change is not None:
+            self.on_change(r)
+
+    def _check_row(self, r):
+        state = self.state_of(r)
+        if state == self.ABSENT:
+            raise KeyError(r)
+        if state == self.EMPTY:
+            raise TypeError("row {} is None".format(r))
+
+    def contains(self, r, v):
+        self._check_row(r)
+        return v in self.members(r)
+
+    def add(self, r, v):
+        self._check_row(r)
+        seg = self._segment(r)
+        if (seg == v).any():
+            return
+        if self.size[r] == self.cap[r]:
+            members = seg[seg != self.TOMBSTONE].tolist()
+            cap = self._slack(len(members) + 1)
+            offset = self._alloc(cap)
+            self._free(r)
+            self.start[r], self.cap[r] = offset, cap
+            self.data[offset: offset + len(members)] = members
+            self.size[r] = self.count[r] = len(members)
+        self.data[self.start[r] + self.size[r]] = v
+        self.size[r] += 1
+        self.count[r] += 1
+        if self.on_change is not None:
+            self.on_change(r)
+
+    def discard(self, r, v):
+        '''
+        :return: True if v was a member of row r
+        '''
+        self._check_row(r)
+        seg = self._segment(r)
+        hit = np.nonzero(seg == v)[0]
+        if len(hit) == 0:
+            return False
+        seg[hit[0]] = self.TOMBSTONE
+        self.count[r] -= 1
+        if self.on_change is not None:
+            self.on_change(r)
+        if 2 * self.count[r] < self.size[r]:
+            members = seg[seg != self.TOMBSTONE].tolist()
+            seg[:] = self.TOMBSTONE
+            seg[:len(members)] = members
+            self.size[r] = len(members)
+        return True
+
+
+class RowSet(MutableSet):
+    '''
+    live set view of one row of IncidenceRows, results of set algebra are plain sets
+    '''
+    __slots__ = ('rows', 'r')
+
+    def __init__(self, rows, r):
+        self.rows = rows
+        self.r = r
+
+    @classmethod
+    def _from_iterable(cls, it):
+        return set(it)
+
+    def __iter__(self):
+        return iter(self.rows.members(self.r))
+
+    def __len__(self):
+        self.rows._check_row(self.r)
+        return self.rows.count.item(self.r)
+
+    def __contains__(self, v):
+        return self.rows.contains(self.r, v)
+
+    def __repr__(self):
+        return "RowSet({})".format(set(self))
+
+    def add(self, v):
+        self.rows.add(self.r, v)
+
+    def discard(self, v):
+        self.rows.discard(self.r, v)
+
+    def remove(self, v):
+        if not self.rows.discard(self.r, v):
+            raise KeyError(v)
+
+    def pop(self):
+        members = self.rows.members(self.r)
+        if len(members) == 0:
+            raise KeyError('pop from an empty set')
+        self.rows.discard(self.r, members[0])
+        return members[0]
+
+    def copy(self):
+        return set(self)
+
+    def union(self, *others):
+        return set(self).union(*others)
+
+    def intersection(self, *others):
+        return set(self).intersection(*others)
+
+    def difference(self, *others):
+        return set(self).difference(*others)
+
+
+class RowsView(MutableMapping):
+    '''
+    dict of sets compatibility view over IncidenceRows: keys are row ids, values RowSet or None.
+    Pickling or deep-copying a view gives a plain dict of sets
+    '''
+    def __init__(self, rows):
+        self.rows = rows
+
+    def __getitem__(self, r):
+        state = self.rows.state_of(r)
+        if state == IncidenceRows.ABSENT:
+            raise KeyError(r)
+        if state == IncidenceRows.EMPTY:
+            return None
+        return RowSet(self.rows, r)
+
+    def __setitem__(self, r, members):
+        if members is not None:
+            members = list(members)
+        self.rows.set_row(r, members)
+
+    def __delitem__(self, r):
+        self.rows.del_row(r)
+
+    def __contains__(self, r):
+        return self.rows.state_of(r) != IncidenceRows.ABSENT
+
+    def __iter__(self):
+        return iter(self.rows.keys())
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __reduce__(self):
+        return dict, (self.to_dict(),)
+
+    def items(self):
+        '''
+        (key, value) pairs read lazily over the keys present when the iteration started;
+        keys removed meanwhile are skipped
+        '''
+        return _ItemsView(self)
+
+    def pop(self, r, *default):
+        if r not in self:
+            if default:
+                return default[0]
+            raise KeyError(r)
+        value = self[r]
+        value = None if value is None else set(value)
+        del self[r]
+        return value
+
+    def touch(self, r):
+        '''
+        nothing to do: the RowSet changes are reported by the rows themselves (IncidenceRows.on_change)
+        '''
+
+    def to_dict(self):
+        return {r: (None if v is None else set(v)) for r, v in self.items()}
+
+
+class _ItemsView:
+    def __init__(self, view):
+        self.view = view
+
+    def __len__(self):
+        return len(self.view)
+
+    def __iter__(self):
+        for r in self.view.rows.keys():
+            if r in self.view:
+                yield r, self.view[r]
+
+
+class CompactTopology:
+    '''
+    Array-backed link/node incidence of GraphBuilder: link -> nodes and node -> links rows in two IncidenceRows.
+    The native operations keep both sides consistent; the link and node views present the former
+    dict-of-sets layout, where each side is edited on its own as GraphBuilder does.
+    About 5x less memory than the dicts of sets (TestFile: 0.26 MB against 1.36 MB), for some run time.
+    A row iterates in the order its ids were written, a Python set in hash-slot order, so the passes that
+    depend on set order see the links in another order: e.g. which of the two links of a node is l1 in
+    run_Combine_PassLinks, i.e. the direction of the joined link. The results can differ slightly from the
+    dict mode (TestFile: 2064 against 2066 links)
+    '''
+    def __init__(self, dtype=np.int32):
+        self.links = IncidenceRows(dtype)
+        self.nodes = IncidenceRows(dtype)
+        self.link = RowsView(self.links)
+        self.node = RowsView(self.nodes)
+
+    @classmethod
+    def from_dicts(cls, link, node, dtype=np.int32):
+        topology = cls(dtype)
+        for rows, d in ((topology.links, link), (topology.nodes, node)):
+            for r, members in d.items():
+                rows.set_row(r, None if members is None else list(members))
+        return topology
+
+    @property
+    def nbytes(self):
+        return self.links.nbytes + self.nodes.nbytes
+
+    def rebuild(self):
+        self.links.rebuild()
+        self.nodes.rebuild()
+
+    def add_link(self, l_idx, nodes):
+        '''
+        add the link row and register the link at each of its (existing) nodes
+        '''
+        nodes = list(nodes)
+        self.links.set_row(l_idx, nodes)
+        for n_idx in nodes:
+            self.nodes.add(n_idx, l_idx)
+
+    def remove_link(self, l_idx):
+        '''
+        :return: set of the nodes the link was connected to
+        '''
+        nodes = self.links.members(l_idx) if self.links.state_of(l_idx) == IncidenceRows.ROW else None
+        if nodes is None:
+            raise KeyError(l_idx)
+        self.links.del_row(l_idx)
+        for n_idx in nodes:
+            self.nodes.discard(n_idx, l_idx)
+        return set(nodes)
+
+    def replace_node(self, target_nid, replaced_id):
+        '''
+        move every link of replaced_id to target_nid and drop replaced_id
+        '''
+        for l_idx in self.nodes.members(replaced_id):
+            self.links.discard(l_idx, replaced_id)
+            self.links.add(l_idx, target_nid)
+            self.nodes.add(target_nid, l_idx)
+        self.nodes.del_row(replaced_id)
+
+    def node_neighbours(self, nids, endpt, endlk):
+        '''
+        nodes one link away from nids, skipping the nodes in endpt and the links in endlk (both are updated),
+        as Node_forward_Node
+        '''
+        li_list = list()
+        for n_idx in nids:
+            li_list.extend(self.nodes.members(n_idx))
+            endpt.add(n_idx)
+        res_node = set()
+        for l_idx in dict.fromkeys(li_list):
+            if l_idx not in endlk:
+                endlk.add(l_idx)
+                for n_idx in self.links.members(l_idx):
+                    if n_idx not in endpt:
+                        res_node.add(n_idx)
+        return list(res_node), endpt, endlk
+
+    def link_neighbours(self, lids, endli):
+        '''
+        links sharing a node with lids, skipping the links in endli (updated with lids), as Line_forward_Line
+        '''
+        nd_list = set()
+        for l_idx in lids:
+            nd_list.update(self.links.members(l_idx))
+            endli.add(l_idx)
+        result = set()
+        for n_idx in nd_list:
+            for l_idx in self.nodes.members(n_idx):
+                if l_idx not in endli:
+                    result.add(l_idx)
+        return list(result), endli
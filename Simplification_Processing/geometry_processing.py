@@ -1,13 +1,70 @@
 from shapely.ops import split, nearest_points
 import shapely
 from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor
 from numpy.linalg import norm
-from data_structure import Queue
 from Angle import *
-from math import pi
+from math import pi, sqrt, nan
 
 
-def check_endpt(pt, li):
+def grid_key(x, y, grid_size):
+    '''
+    :return: integer tuple key of (x, y) on the precision grid of cell grid_size
+    '''
+    return round(x / grid_size), round(y / grid_size)
+
+
+def grid_keys(xy, grid_size):
+    '''
+    grid_key of the rows of an (n, 2) coordinate array, as an (n, 2) int64 array
+    '''
+    return np.rint(xy / grid_size).astype(np.int64)
+
+
+def snap_to_grid(geoms, grid_size):
+    '''
+    :param geoms: sequence of geometries or None
+    :return: list of geoms with every coordinate moved to the nearest multiple of grid_size. Every vertex is
+             kept, even when it then repeats its neighbour
+    '''
+    geoms = list(geoms)
+    if not geoms:
+        return geoms
+    arr = np.empty(len(geoms), dtype=object)
+    arr[:] = geoms
+    return shapely.transform(arr, lambda xy: np.rint(xy / grid_size) * grid_size).tolist()
+
+
+def pt_gap(xy1, xy2, grid_size=None):
+    '''
+    Point.distance of two (x, y) pairs. With a grid_size it is measured between their integer grid keys:
+    equal keys are the same point, other distances come from the integer key difference
+    '''
+    if grid_size is None:
+        return sqrt((xy1[0] - xy2[0]) ** 2 + (xy1[1] - xy2[1]) ** 2)
+    k1, k2 = grid_key(xy1[0], xy1[1], grid_size), grid_key(xy2[0], xy2[1], grid_size)
+    if k1 == k2:
+        return 0.0
+    dx, dy = k1[0] - k2[0], k1[1] - k2[1]
+    return sqrt(dx * dx + dy * dy) * grid_size
+
+
+def pt_distances(xy1, xy2, grid_size=None):
+    '''
+    pt_gap of the rows of two (n, 2) coordinate arrays
+    '''
+    if grid_size is None:
+        vec = xy1 - xy2
+        return np.sqrt(vec[:, 0] * vec[:, 0] + vec[:, 1] * vec[:, 1])
+    vec = grid_keys(xy1, grid_size) - grid_keys(xy2, grid_size)
+    return np.sqrt(vec[:, 0] * vec[:, 0] + vec[:, 1] * vec[:, 1]) * grid_size
+
+
+def check_endpt(pt, li, grid_size=None):
+    if grid_size is not None:
+        coords = shapely.get_coordinates(li)
+        xy = (pt.x, pt.y)
+        return pt_gap(coords[0], xy, grid_size) < 1 or pt_gap(coords[-1], xy, grid_size) < 1
     end1, end2 = endPts(li)
     if end1.distance(pt) < 1 or end2.distance(pt) < 1:
         return True
@@ -112,6 +169,135 @@ def nearest_pt(p, l):
     return brk
 
 
+def split_line_at_points(line, pts, tolerance=1):
+    '''
+    Linear-referencing splitter. All points are projected onto the line at once with line_locate_point,
+    points farther than tolerance from the line or closer than tolerance to the end of the piece they fall on
+    are dropped, and the line is cut in one pass on its coordinate array.
+    Points on the line are used as they are, the others are replaced by their projection.
+    The pieces are returned in the order the former Queue/split_polyline loop produced them
+    (a split piece is removed and its two halves appended to the end of the list)
+    :param line: LineString
+    :param pts: list of Points or (k, 2) coordinate array
+    :param tolerance: (m)
+    :return: list of LineStrings, [line] if no point splits it
+    '''
+    if len(pts) == 0:
+        return [line]
+    if isinstance(pts, np.ndarray) and pts.dtype != object:
+        pts = shapely.points(pts)
+    else:
+        pts = np.array(list(pts), dtype=object)
+    dist = shapely.distance(line, pts)
+    keep = dist <= tolerance
+    if not keep.any():
+        return [line]
+    pts, dist = pts[keep], dist[keep]
+    pt_xy = shapely.get_coordinates(pts)
+    measure = shapely.line_locate_point(line, pts)
+
+    coords = shapely.get_coordinates(line)
+    cum = np.concatenate([[0], np.cumsum(norm(np.diff(coords, axis=0), ord=2, axis=1))])
+    #   cut position: the point itself when it is on the line, its projection otherwise
+    cut_xy = np.where((dist == 0)[:, None], pt_xy, shapely.get_coordinates(shapely.line_interpolate_point(line, measure)))
+
+    #   replay the piece order of the Queue loop on measure intervals: (start, end, start_xy, end_xy)
+    pieces = [(0.0, cum[-1], coords[0], coords[-1])]
+    for m, xy, cut in zip(measure.tolist(), pt_xy, cut_xy):
+        for l_idx, (a, b, a_xy, b_xy) in enumerate(pieces):
+            if a <= m <= b:
+                break
+        else:
+            continue
+        if norm(a_xy - xy) < tolerance or norm(b_xy - xy) < tolerance:
+            #   the point is an end pt of this piece
+            continue
+        pieces.pop(l_idx)
+        pieces.append((a, m, a_xy, cut))
+        pieces.append((m, b, cut, b_xy))
+    if len(pieces) == 1:
+        return [line]
+
+    res_lines = list()
+    for a, b, a_xy, b_xy in pieces:
+        inner = coords[(cum > a) & (cum < b)]
+        if len(inner) and (inner[0] == a_xy).all():
+            inner = inner[1:]
+        if len(inner) and (inner[-1] == b_xy).all():
+            inner = inner[:-1]
+        res_lines.append(LineString(np.vstack([a_xy, inner, b_xy])))
+    return res_lines
+
+
+def _coords_buffer(geoms):
+    '''
+    :return: flat (n, 2) coordinate array of geoms and the number of coordinates of each geometry
+    '''
+    coords, owner = shapely.get_coordinates(geoms, return_index=True)
+    return coords, np.bincount(owner, minlength=len(geoms))
+
+
+def _split_lines_chunk(line_coords, line_sizes, pt_coords, pt_sizes):
+    '''
+    worker of split_lines_at_points: rebuild lines and points from flat coordinate buffers, split them
+    and send the pieces back as flat buffers
+    :return: n_pieces: pieces per line, 0 means the line is not split
+    :return: piece_sizes: number of coordinates of each piece
+    :return: piece_coords: flat (n, 2) coordinates of all pieces
+    '''
+    lines = shapely.linestrings(line_coords, indices=np.repeat(np.arange(len(line_sizes)), line_sizes))
+    pt_ends = np.cumsum(pt_sizes)
+    n_pieces = np.zeros(len(lines), dtype=np.int64)
+    pieces = list()
+    for l_idx, line in enumerate(lines):
+        rd_list = split_line_at_points(line, pt_coords[pt_ends[l_idx] - pt_sizes[l_idx]:pt_ends[l_idx]])
+        if len(rd_list) > 1:
+            n_pieces[l_idx] = len(rd_list)
+            pieces.extend(rd_list)
+    piece_coords, piece_sizes = _coords_buffer(np.array(pieces, dtype=object))
+    return n_pieces, piece_sizes, piece_coords
+
+
+def split_lines_at_points(lines, pts_list, workers=1, chunk_size=2000):
+    '''
+    split_line_at_points over many lines. Every line is split independently, so with workers > 1 the lines are
+    sharded across a process pool as flat coordinate buffers and the pieces come back the same way.
+    Results are collected in input order and coordinates survive the buffers unchanged, so the output equals
+    the serial one (an unsplit line is returned as the input object in both modes)
+    :param lines: list of LineStrings
+    :param pts_list: split points of each line, list of Points or (k, 2) coordinate array
+    :param workers: number of processes
+    :param chunk_size: lines per worker task
+    :return: list of piece lists, aligned with lines
+    '''
+    if workers <= 1 or len(lines) <= chunk_size:
+        return [split_line_at_points(line, pts) for line, pts in tqdm(zip(lines, pts_list), total=len(lines))]
+
+    pt_coords = [i if isinstance(i, np.ndarray) and i.dtype != object
+                 else shapely.get_coordinates(np.array(list(i), dtype=object)) for i in pts_list]
+    bounds = list(range(0, len(lines), chunk_size))
+    tasks = list()
+    for b in bounds:
+        line_coords, line_sizes = _coords_buffer(np.array(lines[b:b + chunk_size], dtype=object))
+        chunk_pts = pt_coords[b:b + chunk_size]
+        tasks.append((line_coords, line_sizes,
+                      np.concatenate(chunk_pts).reshape(-1, 2), np.array([len(i) for i in chunk_pts])))
+
+    res = list()
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        results = ex.map(_split_lines_chunk, *zip(*tasks))
+        for b, (n_pieces, piece_sizes, piece_coords) in tqdm(zip(bounds, results), total=len(bounds)):
+            pieces = shapely.linestrings(piece_coords, indices=np.repeat(np.arange(len(piece_sizes)), piece_sizes))
+            p_idx = 0
+            for l_idx, n in enumerate(n_pieces.tolist()):
+                if n == 0:
+                    res.append([lines[b + l_idx]])
+                else:
+                    res.append(list(pieces[p_idx:p_idx + n]))
+                    p_idx += n
+    return res
+
+
 def get_closest_nd(nd, target_nd):
     '''
     this function find the closest nd of nd among target_nd
@@ -157,6 +343,71 @@ def Points_in_Line(s):
     return pt_list
 
 
+def _dedup_vertices(coords, owner):
+    '''
+    merge the runs of repeated vertices of every line (the zero length segments of separate_lines).
+    The segments LineSimplication keeps start at the last vertex of a run and end at the first one, which
+    only differ by signed zeros, so both are returned
+    :return: start, end: coords of the last and of the first vertex of every run, owner of every run,
+             seg: seg[r] length of the segment from run r to run r + 1
+    '''
+    vec = coords[1:] - coords[:-1]
+    seg = np.sqrt(vec[:, 0] * vec[:, 0] + vec[:, 1] * vec[:, 1])
+    cut = (seg > 0) | (owner[1:] != owner[:-1])
+    last = np.concatenate([cut, [True]])
+    start, end, owner = coords[last], coords[np.concatenate([[True], cut])], owner[last]
+    vec = end[1:] - start[:-1]
+    seg = np.sqrt(vec[:, 0] * vec[:, 0] + vec[:, 1] * vec[:, 1])
+    return start, end, owner, seg
+
+
+def _break_pieces(x, y, seg):
+    '''
+    one pass of the LineSimplication rules over a polyline without repeated vertices. The current piece runs
+    from vertex start to vertex k and meets segment k (k -> k + 1):
+        turning cosine between the piece chord and the segment < 0.8: the piece ends at k
+        piece length + segment length < 50: the piece becomes the straight start -> k + 1
+        otherwise: k + 1 is appended to the piece
+    :param x, y: vertex coordinates (lists of floats)
+    :param seg: seg[k] length of segment k
+    :return: list of the vertex index lists of the pieces
+    '''
+    pieces = list()
+    piece = [0, 1]
+    start = 0
+    length = seg[0]
+    for k in range(1, len(x) - 1):
+        v1x, v1y = x[start] - x[k], y[start] - y[k]
+        v2x, v2y = x[k] - x[k + 1], y[k] - y[k + 1]
+        den = sqrt(v1x * v1x + v1y * v1y) * sqrt(v2x * v2x + v2y * v2y)
+        angle = (v1x * v2x + v1y * v2y) / den if den else nan
+        if angle < 0.8:
+            pieces.append(piece)
+            piece = [k, k + 1]
+            start = k
+            length = seg[k]
+        elif (length + seg[k]) < 50:
+            piece = [start, k + 1]
+            dx, dy = x[k + 1] - x[start], y[k + 1] - y[start]
+            length = sqrt(dx * dx + dy * dy)
+        else:
+            piece.append(k + 1)
+            length = length + seg[k]
+    pieces.append(piece)
+    return pieces
+
+
+def _pieces_result(lines, nodes):
+    '''
+    LineSimplication output of one line from its pieces and their end points
+    '''
+    node_map = {0: {0}}
+    for li_idx in range(len(lines) - 1):
+        node_map[li_idx + 1] = {li_idx, li_idx + 1}
+    node_map[len(lines)] = {len(lines) - 1}
+    return lines, nodes, node_map, True
+
+
 def LineSimplication(s, l_id):
     '''
     line_Simplication only simplify the intermediate pts of segment geometry. Reduce the description and storage burden
@@ -168,48 +419,63 @@ def LineSimplication(s, l_id):
     :return node_map:  relations between links and nodes(nodes to links)
     :return bool: False is for unlinked lines
     '''
-    li_list = separate_lines(s)
-    li_list = [i for i in li_list if i.length > 0]
-    res_lines = list()
-    node_map = dict()
-    res_node = list()
-
-    times = 0
-    if len(li_list) < 2:
-        return None, None, None, False
+    return simplify_lines([s])[0]
 
-    res_node.append(Point(s.xy[0][0], s.xy[1][0]))
-    node_map[0] = {0}
-    while len(li_list) > 1:
-        li1 = li_list[0]
-        li2 = li_list[1]
-        angle = AngleCal(li1, li2)
 
-        if angle < 0.8:
-
-            nd_idx = len(res_node)
-            li_idx = len(res_lines)
-            current_crossing = Point(li1.xy[0][-1], li1.xy[1][-1])
-            node_map[nd_idx] = {li_idx, li_idx + 1}
-            res_node.append(current_crossing)
-            res_lines.append(li_list[0])
-            li_list.pop(0)
-        elif (li1.length + li2.length) < 50:
-            li_list[0] = LineString([(li1.xy[0][0], li1.xy[1][0]), (li2.xy[0][1], li2.xy[1][1])])
-            li_list.pop(1)
-        else:
-            li_list[0] = AddPoint([li1, li2])
-            li_list.pop(1)
-    if len(li_list) > 1:
-        raise ValueError('wrong li_list length:{}'.format(len(li_list)))
-    for i in li_list:
-        nd_idx = len(res_node)
-        li_idx = len(res_lines)
-        current_crossing = Point(i.xy[0][-1], i.xy[1][-1])
-        node_map[nd_idx] = {li_idx}
-        res_node.append(current_crossing)
-        res_lines.append(i)
-    return res_lines, res_node, node_map, True
+def simplify_lines(geoms):
+    '''
+    LineSimplication of many lines at once: the vertices of all lines are read, deduplicated and measured
+    in one go, every line is then decided by one pass of _break_pieces, and all the output LineStrings and
+    Points are built in two shapely calls
+    :param geoms: LineStrings (None allowed)
+    :return: list of the LineSimplication results (res_lines, res_node, node_map, status), one per geometry
+    '''
+    arr = np.empty(len(geoms), dtype=object)
+    arr[:] = list(geoms)
+    res = [(None, None, None, False)] * len(geoms)
+    valid = np.nonzero([g is not None for g in arr])[0]
+    if len(valid) == 0:
+        return res
+    coords, owner = shapely.get_coordinates(arr[valid], return_index=True)
+    if len(coords) == 0:
+        return res
+    start, end, owner, seg = _dedup_vertices(coords, owner)
+    first = np.searchsorted(owner, np.arange(len(valid) + 1))
+    x, y, seg = start[:, 0].tolist(), start[:, 1].tolist(), seg.tolist()
+
+    #   a piece starts at the start coords of its first run and goes through the end coords of the others;
+    #   rows of both: start coords of run r at r, end coords at n_runs + r
+    n_runs = len(start)
+    both = np.concatenate([start, end])
+    done = list()       # (geometry index, number of pieces)
+    piece_idx = list()  # rows of both of the vertices of all pieces
+    piece_of = list()   # piece number of every entry of piece_idx
+    node_idx = list()   # rows of both of the output nodes
+    n_pieces = 0
+    for k, g in enumerate(valid.tolist()):
+        a, b = first[k], first[k + 1]
+        if b - a < 3:
+            #   less than two segments of non-zero length
+            continue
+        pieces = _break_pieces(x[a:b], y[a:b], seg[a:b - 1])
+        node_idx.append(n_runs + a)
+        for p in pieces:
+            piece_idx.append(a + p[0])
+            piece_idx.extend(n_runs + a + i for i in p[1:])
+            piece_of.extend([n_pieces] * len(p))
+            n_pieces += 1
+            node_idx.append(n_runs + a + p[-1])
+        done.append((g, len(pieces)))
+    if not done:
+        return res
+    lines = shapely.linestrings(both[piece_idx], indices=piece_of).tolist()
+    nodes = shapely.points(both[node_idx]).tolist()
+    li, nd = 0, 0
+    for g, n in done:
+        res[g] = _pieces_result(lines[li: li + n], nodes[nd: nd + n + 1])
+        li += n
+        nd += n + 1
+    return res
 
 
 def nodes_split_curve(nodesList, curve):
@@ -220,75 +486,78 @@ def nodes_split_curve(nodesList, curve):
     :return: separateLi(list)
     :return: separateMap(dict) Original geo_keys to separateLi idx mapping
     '''
-    separatLi = list()
+    return split_line_at_points(curve, nodesList)
 
-    rd_geo = curve
-    cross_pt = nodesList
-    pt_que = Queue()
-    rd_list = list()
-    rd_list.append(rd_geo)
-    for pt in cross_pt:
-        pt_que.Que_in(pt)
-    '''
-    use pts to split the link accordingly
-    until all pts are used
-    '''
-    while not pt_que.Que_isEmpty():
-        current_pt = pt_que.Que_out()
-        l_idx = 0
-        while l_idx < len(rd_list):
-            current_li = rd_list[l_idx]
-            dist_to_curve = check_pt_on_curve(current_pt, current_li)
-            #   check the intersection releationship between the currentli and currentpt
-            if dist_to_curve > 1:
-                #   if distance larger than tolerance(1m), than it means this split pt is not correct.
-                l_idx += 1
-                continue
-            if check_endpt(current_pt, current_li):
-                #   check currentpt is endpt or not
-                #   True：  pass
-                #   False: currentpt should split the current_li
-                break
-            else:
-                #   current_pt should split the currentli
-                #   current_pt is direct on current li or not
-                if dist_to_curve == 0:
-                    #   current_pt is on the currentli
-                    break_pt = current_pt
-                    spt_list = split_polyline(break_pt, current_li)
-                    rd_list.pop(l_idx)
-                    rd_list = rd_list + spt_list
-                    break
-                else:
-                    #   current_pt not on currentli
-                    break_pt = nearest_pt(current_pt, current_li)
-                    spt_list = split_polyline(break_pt, current_li)
-
-                    rd_list.pop(l_idx)
-                    rd_list = rd_list + spt_list
-                    break
-    for i in rd_list:
-        idx = len(separatLi)
-        separatLi.append(i)
-
-    return separatLi
-
-
-def CombinePassLinks(l1, l2):
-    l1_list = Points_in_Line(l1)
-    l2_list = Points_in_Line(l2)
-    if l1_list[0].distance(l2_list[0]) < l1_list[-1].distance(l2_list[0]):
-        if l1_list[0].distance(l2_list[0]) < 1:
-            l1_list.reverse()
-            return LineString(l1_list + l2_list)
-        else:
-            return LineString(l2_list + l1_list)
-    else:
-        if l1_list[-1].distance(l2_list[0]) < 1:
-            return LineString(l1_list + l2_list)
-        else:
-            l2_list.reverse()
-            return LineString(l1_list + l2_list)
+
+def pass_links_order(l1_start, l1_end, l2_start, grid_size=None):
+    '''
+    how CombinePassLinks joins l1 and l2, from the (x, y) end points of the two links (see pt_gap for grid_size)
+    :return: swap, rev1, rev2: the joined line is l2 + l1 if swap else l1 + l2, with l1 reversed if rev1 and
+             l2 reversed if rev2
+    '''
+    to_start = pt_gap(l1_start, l2_start, grid_size)
+    to_end = pt_gap(l1_end, l2_start, grid_size)
+    if to_start < to_end:
+        if to_start < 1:
+            return False, True, False
+        return True, False, False
+    if to_end < 1:
+        return False, False, False
+    return False, False, True
+
+
+def CombinePassLinks(l1, l2, grid_size=None):
+    l1_xy = shapely.get_coordinates(l1)
+    l2_xy = shapely.get_coordinates(l2)
+    swap, rev1, rev2 = pass_links_order(l1_xy[0], l1_xy[-1], l2_xy[0], grid_size)
+    if rev1:
+        l1_xy = l1_xy[::-1]
+    if rev2:
+        l2_xy = l2_xy[::-1]
+    if swap:
+        return LineString(np.concatenate([l2_xy, l1_xy]))
+    return LineString(np.concatenate([l1_xy, l2_xy]))
+
+
+def _modification_pass(x, y):
+    '''
+    the LineModification rules in one pass over the vertices of a line. The kept vertices are a stack, its top
+    and the candidate vertex make the current segment, the candidate and the next vertex the following one:
+        cosine of the two segments < 0.8, or their length sum < 50: the candidate is removed
+        otherwise the candidate is kept
+    either way the next vertex becomes the candidate, the last vertex is always kept
+    :param x, y: vertex coordinates (lists of floats)
+    :return: indexes of the kept vertices
+    '''
+    keep = [0]
+    cand = 1
+    for nxt in range(2, len(x)):
+        top = keep[-1]
+        v1x, v1y = x[cand] - x[top], y[cand] - y[top]
+        v2x, v2y = x[nxt] - x[cand], y[nxt] - y[cand]
+        l1, l2 = sqrt(v1x * v1x + v1y * v1y), sqrt(v2x * v2x + v2y * v2y)
+        den = l1 * l2
+        angle = (v1x * v2x + v1y * v2y) / den if den else nan
+        if not (angle < 0.8 or l1 + l2 < 50):
+            keep.append(cand)
+        cand = nxt
+    keep.append(cand)
+    return keep
+
+
+def _modification_keep(x, y, end_identify):
+    '''
+    :return: indexes of the vertices LineModification keeps, None when the line is returned as it is
+    '''
+    if len(x) < 4:
+        return None
+    if len(x) == 4:
+        #   四个点三段线
+        l0, l1, l2 = (sqrt((x[k + 1] - x[k]) ** 2 + (y[k + 1] - y[k]) ** 2) for k in range(3))
+        if l0 < l1 / end_identify and l2 < l1 / end_identify:
+            return [0, 3]
+        return None
+    return _modification_pass(x, y)
 
 
 def LineModification(s, end_identify=3):
@@ -297,40 +566,43 @@ def LineModification(s, end_identify=3):
     :param s:
     :return: a LineString
     '''
-    total_length = s.length
-    pts = np.array(s.xy)
-    if pts.shape[1] < 4:
-        return s
-    vec, vec_length, angle = LineStringVec(pts)
-    if pts.shape[1] == 4:
-        #   四个点三段线
-        if vec_length[0] < vec_length[1] / end_identify and vec_length[2] < vec_length[1] / end_identify:
-            pts = np.delete(pts, [1, 2], axis=1)
-            return LineString(pts.T)
-        else:
-            return s
-    #   先检测波动情况
-    #   波动的情况意味着两个角度的cosine值的正负值是不一样的
-    num_angle = angle.shape[0]
-    angle_idx = 0
-    while angle_idx < num_angle:
-        if angle[angle_idx] < 0.8:
-            #   条件1：说明对应点没有起到形变作用，中间点应该取消
-            #   条件2：说明是回折点，应当被清除
-            #   构成这个角的中间点应当被remove
-            #   重新计算一遍pts、vec和angle
-            mid_pt_idx = angle_idx + 1
-            pts = np.delete(pts, mid_pt_idx, axis=1)
-            vec, vec_length, angle = LineStringVec(pts)
-            num_angle = angle.shape[0]
-        elif vec_length[angle_idx] + vec_length[angle_idx + 1] < 50:
-            mid_pt_idx = angle_idx + 1
-            pts = np.delete(pts, mid_pt_idx, axis=1)
-            vec, vec_length, angle = LineStringVec(pts)
-            num_angle = angle.shape[0]
-        else:
-            angle_idx += 1
-    return LineString(pts.T)
+    return modify_lines([s], end_identify)[0]
+
+
+def modify_lines(geoms, end_identify=3):
+    '''
+    LineModification of many lines at once: the vertices of all lines are read in one go, every line is
+    decided by _modification_keep, and the modified LineStrings are built in one shapely call
+    :param geoms: LineStrings (None allowed)
+    :return: list of the modified geometries, the unchanged ones are the input objects
+    '''
+    arr = np.empty(len(geoms), dtype=object)
+    arr[:] = list(geoms)
+    res = list(arr)
+    valid = np.nonzero([g is not None for g in arr])[0]
+    if len(valid) == 0:
+        return res
+    coords, owner = shapely.get_coordinates(arr[valid], return_index=True)
+    first = np.searchsorted(owner, np.arange(len(valid) + 1)).tolist()
+    x, y = coords[:, 0].tolist(), coords[:, 1].tolist()
+
+    done = list()       # geometry index of every modified line
+    keep_idx = list()   # rows of coords of the vertices of all modified lines
+    keep_of = list()    # position in done of every entry of keep_idx
+    for k, g in enumerate(valid.tolist()):
+        a, b = first[k], first[k + 1]
+        keep = _modification_keep(x[a:b], y[a:b], end_identify)
+        if keep is None:
+            continue
+        keep_idx.extend(a + i for i in keep)
+        keep_of.extend([len(done)] * len(keep))
+        done.append(g)
+    if not done:
+        return res
+    lines = shapely.linestrings(coords[keep_idx], indices=keep_of).tolist()
+    for g, li in zip(done, lines):
+        res[g] = li
+    return res
 
 
 def roundness(s):
@@ -373,68 +645,23 @@ def straighten_links(pt_list):
     return res_list
 
 
-def Crossing_Checking(data, geo_key):
+def Crossing_Checking(data, geo_key, workers=1):
     '''
     This function Generate
     :param data: dict road_idx: "node": node_geos(list), "geometry": road_geos(shapely)
     :param geo_key:
+    :param workers: number of processes splitting the roads (see split_lines_at_points)
     :return: separateLi(list)
     :return: separateMap(dict) he original geo_keys are mapped to separateLi idx
     '''
     separatLi = list()
     separatDict = dict()
 
-    for li in tqdm(range(len(geo_key))):
-        rd_idx = geo_key[li]
-        rd_geo = data[rd_idx]['geometry']
-        cross_pt = data[rd_idx]['nodes']
-
-        if len(cross_pt) == 0:
-            continue
-        pt_que = Queue()
-        rd_list = list()
-        rd_list.append(rd_geo)
-        for pt in cross_pt:
-            pt_que.Que_in(pt)
-        '''
-        Handling each point-following-line case by type.
-        until all pts are used
-        '''
-        while not pt_que.Que_isEmpty():
-            current_pt = pt_que.Que_out()
-            l_idx = 0
-            while l_idx < len(rd_list):
-                current_li = rd_list[l_idx]
-                dist_to_curve = check_pt_on_curve(current_pt, current_li)
-                #    Start detecting the relationship between currentli and currentpt
-                if dist_to_curve > 1:
-                    #   If the distance is greater than 1m, it means that it is not related to this line segment,
-                    #   and you can find the next line directly.
-                    l_idx += 1
-                    continue
-                if check_endpt(current_pt, current_li):
-                    #   check whether the pt is the endpt
-                    #   True：  do not split
-                    #   False: pt should split
-                    break
-                else:
-                    #   find split pt and corresponding link
-                    #   but the split pt may not locate on the the link geometry
-                    if dist_to_curve == 0:
-                        #   the split geometry is on the link geometry
-                        break_pt = current_pt
-                        spt_list = split_polyline(break_pt, current_li)
-                        rd_list.pop(l_idx)
-                        rd_list = rd_list + spt_list
-                        break
-                    else:
-                        #   not on the link geometry
-                        break_pt = nearest_pt(current_pt, current_li)
-                        spt_list = split_polyline(break_pt, current_li)
-
-                        rd_list.pop(l_idx)
-                        rd_list = rd_list + spt_list
-                        break
+    roads = [li for li in range(len(geo_key)) if len(data[geo_key[li]]['nodes'])]
+    rd_lists = split_lines_at_points([data[geo_key[li]]['geometry'] for li in roads],
+                                     [data[geo_key[li]]['nodes'] for li in roads],
+                                     workers=workers)
+    for li, rd_list in zip(roads, rd_lists):
         '''
         The point has completely split the line
         The line is stored in separatLi
@@ -0,0 +1,419 @@
+import numpy as np
+import shapely
+from shapely.geometry import Point
+
+
+class LinkGeometryStore:
+    '''
+    Drop-in replacement of the link_storage list: the vertices of all links live in one contiguous
+    (m, 2) coordinate buffer, link i being buffer[start[i]: start[i] + count[i]]; count -1 is a None slot.
+    Indexing returns a LineString built on demand, so shapely objects only exist while a pass uses them
+    (or at export time); coords() reads the vertices without one. Assigning a geometry rewrites its
+    vertices in place when they fit the old slots, otherwise they are appended; the slots left behind are
+    reclaimed by rebuild(), which runs by itself once they take half of the buffer. The attribute table
+    (attrs) is filled from the buffer by lengths() and endpoints(), for all links at once in from_geoms.
+    '''
+    def __init__(self, capacity=1024):
+        self.buffer = np.empty((capacity, 2))
+        self.start = np.zeros(64, dtype=np.int64)
+        self.count = np.full(64, -1, dtype=np.int32)
+        self.cap = np.zeros(64, dtype=np.int32)
+        self.n = 0          # number of links (slots), None included
+        self.attrs = LinkAttributeTable(capacity)
+        self.end = 0        # used rows of buffer
+        self.garbage = 0    # rows of buffer not owned by any link
+
+    @classmethod
+    def from_geoms(cls, geoms):
+        '''
+        :param geoms: list of LineStrings or None
+        '''
+        geoms = list(geoms)
+        store = cls()
+        arr = np.empty(len(geoms), dtype=object)
+        arr[:] = geoms
+        valid = np.array([g is not None for g in geoms], dtype=bool)
+        coords, owner = shapely.get_coordinates(arr[valid], return_index=True)
+        counts = np.zeros(len(geoms), dtype=np.int64)
+        counts[valid] = np.bincount(owner, minlength=int(valid.sum()))
+        store._ensure_slots(len(geoms))
+        store.buffer = np.empty((max(len(coords), 1024), 2))
+        store.buffer[:len(coords)] = coords
+        store.start[:len(geoms)] = np.cumsum(counts) - counts
+        store.count[:len(geoms)] = np.where(valid, counts, -1)
+        store.cap[:len(geoms)] = counts
+        store.n = len(geoms)
+        store.end = len(coords)
+        store.attrs = LinkAttributeTable(capacity=max(len(geoms), 1024))
+        store.attrs.set_rows(0, store.lengths(), store.endpoints())
+        return store
+
+    def __len__(self):
+        return self.n
+
+    def __iter__(self):
+        for i in range(self.n):
+            yield self[i]
+
+    @property
+    def nbytes(self):
+        return self.buffer.nbytes + self.start.nbytes + self.count.nbytes + self.cap.nbytes
+
+    def _ensure_slots(self, n):
+        if n <= len(self.count):
+            return
+        size = max(2 * len(self.count), n)
+        for name, fill in (('start', 0), ('count', -1), ('cap', 0)):
+            old = getattr(self, name)
+            new = np.full(size, fill, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def _alloc(self, k):
+        if self.end + k > len(self.buffer):
+            if self.garbage > self.end // 2:
+                self.rebuild()
+            if self.end + k > len(self.buffer):
+                new = np.empty((max(2 * len(self.buffer), self.end + k), 2))
+                new[:self.end] = self.buffer[:self.end]
+                self.buffer = new
+        offset = self.end
+        self.end += k
+        return offset
+
+    def rebuild(self):
+        '''
+        rewrite the live links contiguously, in link order
+        '''
+        live = np.nonzero(self.count[:self.n] >= 0)[0]
+        counts = self.count[live].astype(np.int64)
+        src = np.repeat(self.start[live], counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts,
+                                                                                         counts)
+        coords = self.buffer[src]
+        self.buffer = np.empty((max(2 * len(coords), 1024), 2))
+        self.buffer[:len(coords)] = coords
+        self.start[live] = np.cumsum(counts) - counts
+        self.cap[live] = counts
+        self.end = len(coords)
+        self.garbage = 0
+
+    def _index(self, i):
+        if i < 0:
+            i += self.n
+        if not 0 <= i < self.n:
+            raise IndexError("link index {} out of range".format(i))
+        return i
+
+    def take(self, ids):
+        '''
+        :param ids: link ids, in the order of the new store
+        :return: new LinkGeometryStore holding these links
+        '''
+        ids = np.asarray(ids, dtype=np.int64)
+        store = LinkGeometryStore()
+        counts = self.count[ids].astype(np.int64)
+        valid = counts >= 0
+        counts = np.where(valid, counts, 0)
+        first = np.cumsum(counts) - counts
+        src = np.repeat(self.start[ids], counts) + np.arange(counts.sum()) - np.repeat(first, counts)
+        store._ensure_slots(len(ids))
+        store.buffer = np.empty((max(len(src), 1024), 2))
+        store.buffer[:len(src)] = self.buffer[src]
+        store.start[:len(ids)] = first
+        store.count[:len(ids)] = np.where(valid, counts, -1)
+        store.cap[:len(ids)] = counts
+        store.n = len(ids)
+        store.end = len(src)
+        store.attrs = self.attrs.take(ids)
+        return store
+
+    def lengths(self, ids=None):
+        '''
+        :param ids: link ids, all the links by default
+        :return: lengths of the links, nan for None slots. The segment lengths are added in vertex order, as
+                 GEOS does, so they compare equal to LineString.length
+        '''
+        if ids is None:
+            return _line_lengths(self.buffer[:self.end], self.start[:self.n], self.count[:self.n])
+        ids = np.asarray(ids, dtype=np.int64)
+        counts = np.maximum(self.count[ids], 0).astype(np.int64)
+        first = np.cumsum(counts) - counts
+        src = np.repeat(self.start[ids], counts) + np.arange(counts.sum()) - np.repeat(first, counts)
+        return _line_lengths(self.buffer[src], first, self.count[ids])
+
+    def endpoints(self, ids=None):
+        '''
+        :param ids: link ids, all the links by default
+        :return: (len(ids), 2, 2) first and last vertex of the links, nan for None slots
+        '''
+        ids = np.arange(self.n) if ids is None else np.asarray(ids, dtype=np.int64)
+        start, count = self.start[ids], self.count[ids]
+        out = np.full((len(ids), 2, 2), np.nan)
+        live = count > 0
+        out[live, 0] = self.buffer[start[live]]
+        out[live, 1] = self.buffer[start[live] + count[live] - 1]
+        return out
+
+    def coords(self, i):
+        '''
+        :return: (k, 2) vertex array of link i (a copy), None for a None slot
+        '''
+        i = self._index(i)
+        if self.count[i] < 0:
+            return None
+        s = self.start[i]
+        return self.buffer[s: s + self.count[i]].copy()
+
+    def __getitem__(self, i):
+        i = self._index(i)
+        if self.count[i] < 0:
+            return None
+        s = self.start[i]
+        return shapely.linestrings(self.buffer[s: s + self.count[i]])
+
+    def __setitem__(self, i, geom):
+        i = self._index(i)
+        if self.count[i] >= 0 and geom is None:
+            self.garbage += int(self.cap[i])
+            self.start[i] = self.cap[i] = 0
+        if geom is None:
+            self.count[i] = -1
+            self.attrs.set_rows(i, np.nan, np.nan)
+            return
+        coords = shapely.get_coordinates(geom)
+        k = len(coords)
+        if self.count[i] < 0 or self.cap[i] < k:
+            offset = self._alloc(k)
+            if self.count[i] >= 0:
+                self.garbage += int(self.cap[i])
+            self.start[i], self.cap[i] = offset, k
+        s = self.start[i]
+        self.buffer[s: s + k] = coords
+        self.count[i] = k
+        self.attrs.set_rows(i, self.lengths([i]), self.endpoints([i]))
+
+    def append(self, geom):
+        self._ensure_slots(self.n + 1)
+        self.n += 1
+        self.count[self.n - 1] = -1
+        self[self.n - 1] = geom
+
+    def extend(self, geoms):
+        for g in geoms:
+            self.append(g)
+
+
+class NodeGeometryStore:
+    '''
+    Drop-in replacement of the node_storage list: an (n, 2) coordinate array, nan rows are None slots.
+    Indexing returns a Point built on demand
+    '''
+    def __init__(self, capacity=1024):
+        self.xy = np.full((capacity, 2), np.nan)
+        self.n = 0
+
+    @classmethod
+    def from_geoms(cls, geoms):
+        geoms = list(geoms)
+        store = cls(capacity=max(len(geoms), 1024))
+        for i, g in enumerate(geoms):
+            if g is not None:
+                store.xy[i] = (g.x, g.y)
+        store.n = len(geoms)
+        return store
+
+    def __len__(self):
+        return self.n
+
+    def __iter__(self):
+        for i in range(self.n):
+            yield self[i]
+
+    @property
+    def nbytes(self):
+        return self.xy.nbytes
+
+    def _index(self, i):
+        if i < 0:
+            i += self.n
+        if not 0 <= i < self.n:
+            raise IndexError("node index {} out of range".format(i))
+        return i
+
+    def take(self, ids):
+        store = NodeGeometryStore(capacity=max(len(ids), 1024))
+        store.xy[:len(ids)] = self.xy[ids]
+        store.n = len(ids)
+        return store
+
+    def coords(self):
+        '''
+        :return: (n, 2) coordinates, nan rows for None slots
+        '''
+        return self.xy[:self.n]
+
+    def __getitem__(self, i):
+        x, y = self.xy[self._index(i)]
+        if x != x:  # nan
+            return None
+        return Point(x, y)
+
+    def __setitem__(self, i, geom):
+        i = self._index(i)
+        self.xy[i] = np.nan if geom is None else (geom.x, geom.y)
+
+    def append(self, geom):
+        if self.n == len(self.xy):
+            new = np.full((2 * len(self.xy), 2), np.nan)
+            new[:self.n] = self.xy
+            self.xy = new
+        self.n += 1
+        self[self.n - 1] = geom
+
+    def extend(self, geoms):
+        for g in geoms:
+            self.append(g)
+
+
+class LinkAttributeTable:
+    '''
+    Per-link attributes kept in step with the link geometries: length and start/end coordinates. Rows of None
+    slots are nan. The length is the GEOS length, so it compares equal to LineString.length
+    '''
+    def __init__(self, capacity=1024):
+        self.length = np.full(capacity, np.nan)
+        self.ends = np.full((capacity, 2, 2), np.nan)
+        self.on_change = None   # optional callable(link id) called on every row written
+
+    @classmethod
+    def from_geoms(cls, geoms):
+        table = cls(capacity=max(len(geoms), 1024))
+        table.set_many(0, geoms)
+        return table
+
+    def take(self, ids):
+        table = LinkAttributeTable(capacity=max(len(ids), 1024))
+        table.length[:len(ids)] = self.length[ids]
+        table.ends[:len(ids)] = self.ends[ids]
+        return table
+
+    def _ensure(self, n):
+        if n <= len(self.length):
+            return
+        size = max(2 * len(self.length), n)
+        for name in ('length', 'ends'):
+            old = getattr(self, name)
+            new = np.full((size,) + old.shape[1:], np.nan)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def set(self, i, geom):
+        self._ensure(i + 1)
+        if self.on_change is not None:
+            self.on_change(i)
+        if geom is None:
+            self.length[i] = np.nan
+            self.ends[i] = np.nan
+            return
+        coords = shapely.get_coordinates(geom)
+        self.length[i] = geom.length
+        self.ends[i] = coords[[0, -1]]
+
+    def set_rows(self, first, length, ends):
+        '''
+        write the rows first, first + 1, ... from length and (n, 2, 2) ends arrays (or nan)
+        '''
+        n = np.size(length)
+        self._ensure(first + n)
+        if self.on_change is not None:
+            for i in range(first, first + n):
+                self.on_change(i)
+        self.length[first: first + n] = length
+        self.ends[first: first + n] = ends
+
+    def set_many(self, first, geoms):
+        '''
+        vectorized set of the rows first, first + 1, ... from a sequence of LineStrings or None
+        '''
+        n = len(geoms)
+        self._ensure(first + n)
+        if self.on_change is not None:
+            for i in range(first, first + n):
+                self.on_change(i)
+        arr = np.empty(n, dtype=object)
+        arr[:] = list(geoms)
+        valid = np.array([g is not None for g in arr], dtype=bool)
+        rows = first + np.nonzero(valid)[0]
+        self.length[first: first + n] = np.nan
+        self.ends[first: first + n] = np.nan
+        if len(rows) == 0:
+            return
+        coords, owner = shapely.get_coordinates(arr[valid], return_index=True)
+        counts = np.bincount(owner, minlength=len(rows))
+        head = np.cumsum(counts) - counts
+        tail = head + counts - 1
+        self.length[rows] = shapely.length(arr[valid])
+        self.ends[rows, 0] = coords[head]
+        self.ends[rows, 1] = coords[tail]
+
+
+class LinkList(list):
+    '''
+    link_storage list keeping a LinkAttributeTable (attrs) updated on every item assignment and append
+    '''
+    def __init__(self, geoms=()):
+        super().__init__(geoms)
+        self.attrs = LinkAttributeTable.from_geoms(self)
+
+    def coords(self, i):
+        '''
+        :return: (k, 2) vertex array of link i, None for a None slot
+        '''
+        geom = self[i]
+        return None if geom is None else shapely.get_coordinates(geom)
+
+    def take(self, ids):
+        '''
+        :return: new LinkList of the links ids, in that order
+        '''
+        links = LinkList.__new__(LinkList)
+        list.__init__(links, [list.__getitem__(self, i) for i in ids])
+        links.attrs = self.attrs.take(ids)
+        return links
+
+    def __setitem__(self, i, geom):
+        super().__setitem__(i, geom)
+        self.attrs.set(i if i >= 0 else len(self) + i, geom)
+
+    def append(self, geom):
+        super().append(geom)
+        self.attrs.set(len(self) - 1, geom)
+
+    def extend(self, geoms):
+        geoms = list(geoms)
+        first = len(self)
+        super().extend(geoms)
+        self.attrs.set_many(first, geoms)
+
+
+def _line_lengths(coords, start, count):
+    '''
+    :param coords: (m, 2) vertex array, line i being coords[start[i]: start[i] + count[i]]; count -1 is None
+    :return: lengths of the lines, nan for None. The segment lengths of every line are added one after the
+             other from its first vertex, as GEOS does
+    '''
+    out = np.where(count >= 0, 0.0, np.nan)
+    if len(coords) < 2:
+        return out
+    vec = np.diff(coords, axis=0)
+    seg = np.sqrt(vec[:, 0] * vec[:, 0] + vec[:, 1] * vec[:, 1])    # vertex j to j + 1 of coords
+    #   lines by decreasing vertex count: the lines with a k-th segment are a prefix of order
+    order = np.argsort(-count, kind='stable')
+    start, count = start[order], count[order]
+    total = out[order]
+    tail = len(order)
+    for k in range(1, int(count.max(initial=0))):
+        tail = np.searchsorted(-count[:tail], -k, side='left')
+        total[:tail] += seg[start[:tail] + k - 1]
+    out[order] = total
+    return out
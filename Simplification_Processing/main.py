@@ -1,9 +1,30 @@
 from Graph_structure import *
+from noding import assign_split_nodes, build_topology
 import warnings
 warnings.simplefilter("ignore")
 #%%
 fileaddress = "./TestFile/TestFile.shp"
 savename = 'testings'
+# True: noding.build_topology splits and connects the roads in one pass (other link/node ids, and the result
+# can differ slightly from the legacy path)
+# False: Crossing_Checking, then GraphBuilder.graph_connections / graph_establishment
+single_pass = False
+# intersection backend: 'strtree' tests line pairs with overlapping bounding boxes,
+# 'sweep' intersects the segments of all lines in one sorted-strip sweep (very large networks)
+noding_method = 'strtree'
+# True keeps the link/node topology in compact int arrays (CompactTopology) instead of dicts of sets:
+# much less memory on very large networks, at the price of slower set operations; links are visited in
+# another order, so the result can differ slightly
+compact = False
+# True keeps link/node geometries in coordinate buffers (geometry_store) instead of lists of shapely objects
+packed_geometry = False
+# True renumbers links and nodes densely between the stages of GraphBuilder.run, dropping the None slots;
+# the old ids are saved in <savename>Graph_remap.pkl. The sets of the renumbered ids iterate in another
+# order, so the result can differ (TestFile: 2065 links instead of 2066)
+compaction = False
+# precision grid (m) of GraphBuilder, e.g. 0.01 for 1 cm: the input coordinates are snapped to it and the
+# endpoint tests compare integer grid keys; None compares the float coordinates
+grid_size = None
 data = gpd.read_file(fileaddress).to_crs('epsg:3857')
 type = data['highway'].value_counts().to_dict()
 desired_type = [
@@ -33,29 +54,19 @@ data = data.set_index('OBJECTID').to_dict('index')
 
 
 geo_keys = [i for i in data]
-for o in tqdm(range(len(geo_keys))):
-    for d in range(o + 1, len(geo_keys)):
-        line1_idx = o
-        line2_idx = d
-        line1 = data[geo_keys[o]]['geometry']
-        line2 = data[geo_keys[d]]['geometry']
-        if line1.intersects(line2):
-            intersectionPT = line1.intersection(line2)
-            if intersectionPT.type == 'MultiPoint':
-                for i in intersectionPT.geoms:
-                    data[geo_keys[o]]['nodes'].append(i)
-                    data[geo_keys[d]]['nodes'].append(i)
-            elif intersectionPT.type == 'Point':
-                data[geo_keys[o]]['nodes'].append(intersectionPT)
-                data[geo_keys[d]]['nodes'].append(intersectionPT)
+if single_pass:
+    linkstg, link, node, node_storage = build_topology([data[k]['geometry'] for k in geo_keys], method=noding_method)
+else:
+    assign_split_nodes(data, geo_keys, method=noding_method)
+    separatLi, _ = Crossing_Checking(data, geo_keys)
 
-separatLi, _ = Crossing_Checking(data, geo_keys)
+    linkstg = []
+    for i in range(len(separatLi)):
+        linkstg.append(separatLi[i])
+    link, node, node_storage = dict(), dict(), list()
 
-linkstg = []
-for i in range(len(separatLi)):
-    linkstg.append(separatLi[i])
 
-
-urn_graph = GraphBuilder(linkstg,dict(), dict(), list(),savename)
-urn_graph.run()
+urn_graph = GraphBuilder(linkstg, link, node, node_storage, savename, compact=compact,
+                         packed_geometry=packed_geometry, compaction=compaction, grid_size=grid_size)
+urn_graph.run(noded=single_pass)
 urn_graph.save()
@@ -0,0 +1,408 @@
+import numpy as np
+import shapely
+from concurrent.futures import ProcessPoolExecutor
+from shapely.geometry import Point
+from shapely.strtree import STRtree
+from data_structure import NodeRegistry
+from geometry_processing import split_line_at_points, split_lines_at_points
+
+#   geometry set of a worker process, received once through the pool initializer
+_worker_geoms = None
+
+
+def as_geometry_array(geoms):
+    '''
+    :param geoms: GeoSeries, list or array of LineStrings
+    :return: 1-d object array of the geometries
+    '''
+    out = np.empty(len(geoms), dtype=object)
+    out[:] = list(geoms)
+    return out
+
+
+def candidate_pairs(geoms):
+    '''
+    pairs of lines whose bounding boxes overlap, found with one bulk STRtree query
+    :param geoms: object array of LineStrings, None and empty geometries are ignored
+    :return: src, dst: index arrays with src < dst, sorted by (src, dst)
+    '''
+    tree = STRtree(geoms)
+    src, dst = tree.query(geoms)
+    keep = src < dst
+    src, dst = src[keep], dst[keep]
+    order = np.lexsort((dst, src))
+    return src[order], dst[order]
+
+
+def crossing_points(geoms, src, dst, exhaustive=False):
+    '''
+    crossing points of candidate pairs
+    :param geoms: object array of LineStrings
+    :param src: index array of the first line of each pair
+    :param dst: index array of the second line of each pair
+    :param exhaustive: False ignores every intersection that is not a Point/MultiPoint (collinear overlaps),
+                       as the former pair loops did. True also keeps the points of GeometryCollections and
+                       the ends of overlapping parts, as graph_connections does
+    :return: i, j, xy: one row per crossing point, xy is an (n, 2) coordinate array
+    '''
+    hit = shapely.intersects(geoms[src], geoms[dst])
+    src, dst = src[hit], dst[hit]
+    inter = shapely.intersection(geoms[src], geoms[dst])
+    if exhaustive:
+        inter, pair = shapely.get_parts(inter, return_index=True)
+        src, dst = src[pair], dst[pair]
+        is_line = np.isin(shapely.get_type_id(inter), [1, 2])  # LineString, LinearRing
+        inter[is_line] = shapely.boundary(inter[is_line])
+    else:
+        type_id = shapely.get_type_id(inter)
+        is_pt = (type_id == 0) | (type_id == 4)  # Point, MultiPoint
+        src, dst, inter = src[is_pt], dst[is_pt], inter[is_pt]
+    xy, pair = shapely.get_coordinates(inter, return_index=True)
+    return src[pair], dst[pair], xy
+
+
+def self_crossing_points(geoms):
+    '''
+    points where a line crosses or touches itself. Noding the line splits it there, so these are the
+    piece ends shared by more than two pieces
+    :param geoms: object array of LineStrings
+    :return: i, j, xy with i == j, in the layout of crossing_points
+    '''
+    valid = ~shapely.is_missing(geoms) & ~shapely.is_empty(geoms)
+    line_idx = np.nonzero(valid)[0]
+    line_idx = line_idx[~shapely.is_simple(geoms[line_idx])]
+    res_i = [np.empty(0, dtype=np.intp)]
+    res_xy = [np.empty((0, 2))]
+    for k in line_idx:
+        pieces = shapely.get_parts(shapely.node(geoms[k]))
+        ends = np.concatenate([shapely.get_coordinates(shapely.get_point(pieces, 0)),
+                               shapely.get_coordinates(shapely.get_point(pieces, -1))])
+        xy, counts = np.unique(ends, axis=0, return_counts=True)
+        xy = xy[counts > 2]
+        res_i.append(np.full(len(xy), k, dtype=np.intp))
+        res_xy.append(xy)
+    i = np.concatenate(res_i)
+    return i, i, np.concatenate(res_xy)
+
+
+def segment_arrays(geoms):
+    '''
+    break every line into its segments (zero-length segments are skipped)
+    :param geoms: object array of LineStrings
+    :return: p1, p2: (m, 2) start and end coordinates, owner: line index of each segment.
+             Segments are in line order, then in vertex order, so the segment index also orders them along a line
+    '''
+    valid = ~shapely.is_missing(geoms) & ~shapely.is_empty(geoms)
+    xy, owner = shapely.get_coordinates(geoms[valid], return_index=True)
+    owner = np.nonzero(valid)[0][owner]
+    start = np.nonzero((owner[1:] == owner[:-1]) & np.any(xy[1:] != xy[:-1], axis=1))[0]
+    return xy[start], xy[start + 1], owner[start]
+
+
+def sweep_candidate_segments(p1, p2, owner, strip_count=None, block_size=2000000):
+    '''
+    sorted-strip sweep: the extent is cut into horizontal strips, every segment is entered in each strip it spans,
+    and each strip is swept in x order, so a segment is only paired with the following segments whose x range
+    starts before its own ends. A pair is reported in the strip holding the larger of the two minimum y only,
+    i.e. exactly once. Segments of the same line are never paired
+    :param p1: (m, 2) segment starts
+    :param p2: (m, 2) segment ends
+    :param owner: line index of each segment
+    :param strip_count: number of strips, sqrt(m) by default
+    :param block_size: upper bound of sweep pairs expanded at once, bounds the memory of very large networks
+    :return: generator of (a, b) segment index arrays
+    '''
+    m = len(p1)
+    if m == 0:
+        return
+    lo = np.minimum(p1, p2)
+    hi = np.maximum(p1, p2)
+    if strip_count is None:
+        strip_count = max(1, int(np.sqrt(m)))
+    y0 = lo[:, 1].min()
+    height = (hi[:, 1].max() - y0) / strip_count or 1.0
+    s_lo = np.minimum(((lo[:, 1] - y0) / height).astype(np.intp), strip_count - 1)
+    s_hi = np.minimum(((hi[:, 1] - y0) / height).astype(np.intp), strip_count - 1)
+
+    #   one entry per (strip, segment)
+    span = s_hi - s_lo + 1
+    seg = np.repeat(np.arange(m), span)
+    strip = s_lo[seg] + np.arange(len(seg)) - np.repeat(np.cumsum(span) - span, span)
+    #   x positions as ranks among all segment starts, so that (strip, x) is an exact integer key
+    xs = np.sort(lo[:, 0])
+    key = strip * (m + 1) + np.searchsorted(xs, lo[seg, 0], 'right')
+    order = np.argsort(key, kind='stable')
+    seg, strip, key = seg[order], strip[order], key[order]
+    end = np.searchsorted(key, strip * (m + 1) + np.searchsorted(xs, hi[seg, 0], 'right'), 'right')
+    counts = end - np.arange(len(seg)) - 1
+
+    cum = np.cumsum(counts)
+    start = 0
+    while start < len(seg):
+        stop = int(np.searchsorted(cum, (cum[start - 1] if start else 0) + block_size, 'right'))
+        stop = max(stop, start + 1)
+        cnt = counts[start:stop]
+        k = np.repeat(np.arange(start, stop), cnt)
+        l = k + 1 + np.arange(len(k)) - np.repeat(np.cumsum(cnt) - cnt, cnt)
+        a, b = seg[k], seg[l]
+        keep = (owner[a] != owner[b]) & (lo[a, 1] <= hi[b, 1]) & (lo[b, 1] <= hi[a, 1]) & \
+               (strip[k] == np.maximum(s_lo[a], s_lo[b]))
+        yield a[keep], b[keep]
+        start = stop
+
+
+def _cross(u, v):
+    return u[:, 0] * v[:, 1] - u[:, 1] * v[:, 0]
+
+
+def segment_intersections(p1, p2, q1, q2):
+    '''
+    intersection of segment pairs. An end lying on the other segment is returned with its exact coordinates,
+    as GEOS does; proper crossings are interpolated and can differ from GEOS in the last digits
+    :param p1, p2: (n, 2) ends of the first segments
+    :param q1, q2: (n, 2) ends of the second segments
+    :return: is_pt: pairs meeting in one point, pt: (n, 2) that point,
+             is_overlap: collinear pairs sharing a part, ov1, ov2: (n, 2) ends of that part
+    '''
+    r = p2 - p1
+    s = q2 - q1
+    o_q1 = np.sign(_cross(r, q1 - p1))
+    o_q2 = np.sign(_cross(r, q2 - p1))
+    o_p1 = np.sign(_cross(s, p1 - q1))
+    o_p2 = np.sign(_cross(s, p2 - q1))
+    collinear = (o_q1 == 0) & (o_q2 == 0)
+
+    meet = ~collinear & (o_q1 * o_q2 <= 0) & (o_p1 * o_p2 <= 0)
+    pt = np.full(p1.shape, np.nan)
+    proper = meet & (o_q1 != 0) & (o_q2 != 0) & (o_p1 != 0) & (o_p2 != 0)
+    t = _cross(q1[proper] - p1[proper], s[proper]) / _cross(r[proper], s[proper])
+    pt[proper] = p1[proper] + t[:, None] * r[proper]
+    for o, end in ((o_q2, q2), (o_q1, q1), (o_p2, p2), (o_p1, p1)):
+        touch = meet & (o == 0)
+        pt[touch] = end[touch]
+
+    #   collinear pairs: overlap of the parameter intervals along the first segment
+    rr = np.einsum('ij,ij->i', r, r)
+    t1 = np.einsum('ij,ij->i', q1 - p1, r) / rr
+    t2 = np.einsum('ij,ij->i', q2 - p1, r) / rr
+    q_lo = np.where((t1 <= t2)[:, None], q1, q2)
+    q_hi = np.where((t1 <= t2)[:, None], q2, q1)
+    t_lo, t_hi = np.minimum(t1, t2), np.maximum(t1, t2)
+    ov1 = np.where((t_lo <= 0)[:, None], p1, q_lo)
+    ov2 = np.where((t_hi >= 1)[:, None], p2, q_hi)
+    a, b = np.maximum(t_lo, 0), np.minimum(t_hi, 1)
+    is_overlap = collinear & (a < b)
+    touch = collinear & (a == b)
+    pt[touch] = ov1[touch]
+    return meet | touch, pt, is_overlap, ov1, ov2
+
+
+def sweep_crossing_points(geoms, exhaustive=False, strip_count=None, block_size=2000000):
+    '''
+    crossing points of all line pairs from a sweep over the segments instead of an STRtree over whole lines.
+    Same semantics as crossing_points: without exhaustive a pair sharing a collinear part is ignored altogether,
+    with exhaustive the ends of the shared segment parts are split points too.
+    Points of a pair are ordered along the first line and not in GEOS output order
+    :param geoms: object array of LineStrings
+    :param strip_count: see sweep_candidate_segments
+    :param block_size: see sweep_candidate_segments
+    :return: i, j, xy, in the layout of crossing_points
+    '''
+    p1, p2, owner = segment_arrays(geoms)
+    res = {'a': [], 'b': [], 'xy': [], 'overlap': []}
+    for a, b in sweep_candidate_segments(p1, p2, owner, strip_count, block_size):
+        is_pt, pt, is_overlap, ov1, ov2 = segment_intersections(p1[a], p2[a], p1[b], p2[b])
+        for sel, xy, flag in ((is_pt, pt, False), (is_overlap, ov1, True), (is_overlap, ov2, True)):
+            res['a'].append(a[sel])
+            res['b'].append(b[sel])
+            res['xy'].append(xy[sel])
+            res['overlap'].append(np.full(np.count_nonzero(sel), flag))
+    if not res['a']:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp), np.empty((0, 2))
+    a, b = np.concatenate(res['a']), np.concatenate(res['b'])
+    xy, overlap = np.concatenate(res['xy']), np.concatenate(res['overlap'])
+
+    #   the first line of a pair is the lower line index
+    swap = owner[a] > owner[b]
+    a, b = np.where(swap, b, a), np.where(swap, a, b)
+    i, j = owner[a], owner[b]
+    if exhaustive:
+        keep = np.ones(len(i), dtype=bool)
+    else:
+        pair_key = i * len(geoms) + j
+        keep = ~np.isin(pair_key, pair_key[overlap])
+    i, j, a, b, xy = i[keep], j[keep], a[keep], b[keep], xy[keep]
+
+    #   along the first line: segment, then distance from the segment start; duplicates of a pair dropped
+    along = np.hypot(xy[:, 0] - p1[a, 0], xy[:, 1] - p1[a, 1])
+    order = np.lexsort((along, a, j, i))
+    i, j, xy = i[order], j[order], xy[order]
+    coords = np.column_stack([i, j, xy.view(np.int64)])
+    _, first = np.unique(coords, axis=0, return_index=True)
+    first = np.sort(first)
+    return i[first], j[first], xy[first]
+
+
+def group_by_line(n, i, j, xy):
+    '''
+    distribute crossing points to both lines of their pair (once if i == j).
+    Points of each line are ordered by partner line index, the order the former double loop appended them in
+    :param n: number of lines
+    :return: list of (k, 2) coordinate arrays, one per line
+    '''
+    other = i != j
+    line = np.concatenate([i, j[other]])
+    partner = np.concatenate([j, i[other]])
+    seq = np.arange(len(line))
+    order = np.lexsort((seq, partner, line))
+    xy = np.concatenate([xy, xy[other]])[order]
+    counts = np.bincount(line[order], minlength=n)
+    return np.split(xy, np.cumsum(counts)[:-1])
+
+
+def _init_worker(geoms_wkb):
+    global _worker_geoms
+    _worker_geoms = shapely.from_wkb(geoms_wkb)
+
+
+def _crossing_points_chunk(src, dst, exhaustive):
+    return crossing_points(_worker_geoms, src, dst, exhaustive)
+
+
+def parallel_crossing_points(geoms, src, dst, workers, chunk_size=20000, progress=None, exhaustive=False):
+    '''
+    crossing_points over a process pool. The geometry set is sent to each worker once as WKB,
+    then every task is a contiguous slice of the pair arrays and returns flat (i, j, xy) arrays.
+    Chunks are collected in submission order, so the result equals the serial one
+    :param workers: number of processes
+    :param chunk_size: candidate pairs per task
+    :param progress: optional callable(done_pairs, total_pairs)
+    '''
+    total = len(src)
+    bounds = list(range(0, total, chunk_size))
+    geoms_wkb = shapely.to_wkb(geoms)
+    res_i, res_j, res_xy = [np.empty(0, dtype=src.dtype)], [np.empty(0, dtype=dst.dtype)], [np.empty((0, 2))]
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(geoms_wkb,)) as ex:
+        results = ex.map(_crossing_points_chunk,
+                         [src[b:b + chunk_size] for b in bounds],
+                         [dst[b:b + chunk_size] for b in bounds],
+                         [exhaustive] * len(bounds))
+        for b, (i, j, xy) in zip(bounds, results):
+            res_i.append(i)
+            res_j.append(j)
+            res_xy.append(xy)
+            if progress is not None:
+                progress(min(b + chunk_size, total), total)
+    return np.concatenate(res_i), np.concatenate(res_j), np.concatenate(res_xy)
+
+
+def split_points(geoms, workers=1, chunk_size=20000, progress=None, exhaustive=False, method='strtree'):
+    '''
+    Noding of a road network: where every line has to be split by the other lines
+    :param geoms: GeoSeries, list or array of LineStrings
+    :param workers: number of processes for the intersection step; 1 runs it in this process.
+                    The sweep backend always runs in this process
+    :param chunk_size: candidate pairs per worker task
+    :param progress: optional callable(done_pairs, total_pairs)
+    :param exhaustive: also split at the ends of overlaps (see crossing_points)
+    :param method: 'strtree' tests the line pairs with overlapping bounding boxes,
+                   'sweep' intersects the segments of all lines in one sorted-strip sweep (see sweep_crossing_points)
+    :return: list of (k, 2) split-point coordinate arrays, aligned with geoms
+    '''
+    geoms = as_geometry_array(geoms)
+    if method == 'sweep':
+        i, j, xy = sweep_crossing_points(geoms, exhaustive)
+        if progress is not None:
+            progress(1, 1)
+        return group_by_line(len(geoms), i, j, xy)
+    if method != 'strtree':
+        raise ValueError("unknown noding method: {}".format(method))
+    src, dst = candidate_pairs(geoms)
+    if workers > 1 and len(src) > chunk_size:
+        i, j, xy = parallel_crossing_points(geoms, src, dst, workers, chunk_size, progress, exhaustive)
+    else:
+        i, j, xy = crossing_points(geoms, src, dst, exhaustive)
+        if progress is not None:
+            progress(len(src), len(src))
+    return group_by_line(len(geoms), i, j, xy)
+
+
+def assign_split_nodes(data, geo_key, workers=1, progress=None, method='strtree'):
+    '''
+    fill data[road_idx]['nodes'] with the split points of every road, the input expected by Crossing_Checking
+    :param data: dict road_idx: "nodes": node_geos(list), "geometry": road_geos(shapely)
+    :param geo_key: road ids of data
+    :param workers: number of processes for the intersection step
+    :param progress: optional callable(done_pairs, total_pairs)
+    :param method: intersection backend, 'strtree' or 'sweep' (see split_points)
+    :return: data
+    '''
+    pts_list = split_points([data[k]['geometry'] for k in geo_key], workers=workers, progress=progress,
+                            method=method)
+    for k, pts in zip(geo_key, pts_list):
+        data[k]['nodes'].extend(shapely.points(pts).tolist())
+    return data
+
+
+def build_topology(geoms, tolerance=1, workers=1, progress=None, method='strtree', points=False):
+    '''
+    Single-pass noding: split every line at all of its crossings and emit the URN topology directly,
+    so GraphBuilder does not need graph_connections and graph_establishment.
+    As in Crossing_Checking, lines without any crossing are dropped.
+    Points where a line crosses itself are applied to each piece separately afterwards, since one of them can
+    be an end of the whole line and an interior vertex of a piece at the same time.
+    Piece ends closer than tolerance are the same node (the first registered end keeps its position);
+    a node is only created where at least two pieces meet, as graph_connections did.
+    :param geoms: GeoSeries, list or array of LineStrings
+    :param tolerance: snapping distance of piece ends (m)
+    :param workers: number of processes for the intersection and splitting steps
+    :param progress: optional callable(done_pairs, total_pairs)
+    :param method: intersection backend, 'strtree' or 'sweep' (see split_points)
+    :param points: also return the split points of every line (list of (k, 2) arrays aligned with geoms), e.g. to
+                   fill the 'nodes' of the input roads as assign_split_nodes does
+    :return: link_storage(list), link(dict link -> nodes), node(dict node -> links), node_storage(list)
+             [, split points]
+    '''
+    geoms = as_geometry_array(geoms)
+    pts_list = split_points(geoms, workers=workers, progress=progress, exhaustive=True, method=method)
+    k, _, k_xy = self_crossing_points(geoms)
+    self_pts_list = group_by_line(len(geoms), k, k, k_xy)
+    roads = [k for k in range(len(geoms)) if len(pts_list[k])]
+    rd_lists = split_lines_at_points(list(geoms[roads]), [pts_list[k] for k in roads], workers=workers)
+    link_storage = list()
+    for k, pieces in zip(roads, rd_lists):
+        if len(self_pts_list[k]):
+            pieces = [j for i in pieces for j in split_line_at_points(i, self_pts_list[k])]
+        link_storage.extend(pieces)
+
+    pieces = as_geometry_array(link_storage)
+    ends = np.empty((2 * len(pieces), 2))
+    ends[0::2] = shapely.get_coordinates(shapely.get_point(pieces, 0))
+    ends[1::2] = shapely.get_coordinates(shapely.get_point(pieces, -1))
+
+    registry = NodeRegistry(tolerance=tolerance)
+    cluster_geom = list()
+    cluster_links = list()
+    for k, (x, y) in enumerate(ends.tolist()):
+        c_idx = registry.find(x, y)
+        if c_idx is None:
+            c_idx = len(cluster_geom)
+            registry.insert(c_idx, x, y)
+            cluster_geom.append((x, y))
+            cluster_links.append(set())
+        cluster_links[c_idx].add(k // 2)
+
+    link = {l_idx: set() for l_idx in range(len(link_storage))}
+    node = dict()
+    node_storage = list()
+    for (x, y), li_set in zip(cluster_geom, cluster_links):
+        if len(li_set) < 2:
+            continue
+        n_idx = len(node_storage)
+        node_storage.append(Point(x, y))
+        node[n_idx] = li_set
+        for l_idx in li_set:
+            link[l_idx].add(n_idx)
+    if points:
+        return link_storage, link, node, node_storage, pts_list
+    return link_storage, link, node, node_storage